@@ -42,12 +42,14 @@ setup(
         'python-dateutil==2.1',
         'python-slugify==0.0.3',
         'requests==1.0.4',
+        'scandir==1.10.0',
     ],
     entry_points={
         'console_scripts': [
             'shiva-server = shiva.app:main',
             'shiva-indexer = shiva.indexer:main',
             'shiva-fileserver = shiva.fileserver:main',
+            'shiva-benchmark = shiva.benchmark:main',
         ]
     }
 )
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime
 import sys
 
-from flask import Flask, g, request
+from flask import Flask, g, has_request_context, request
 from flask.ext.restful import Api
+from werkzeug.http import is_resource_modified
 
-from shiva import resources
+from shiva import get_version, resources
 from shiva.config import Configurator
+from shiva.decorators import set_cors_origin
+from shiva.http import JSONResponse
+from shiva.library import (get_library_version, get_library_version_path,
+                           track_library_changes)
 from shiva.models import db
 
 app = Flask(__name__)
@@ -13,6 +19,24 @@ app.config.from_object(Configurator())
 db.app = app
 db.init_app(app)
 
+
+def is_safe_request():
+    """
+    Tells whether a GET or HEAD request is being served. The only writes made
+    by those cache what was scraped, like lyrics, and the responses don't
+    change because of them.
+
+    """
+
+    return has_request_context() and request.method in ('GET', 'HEAD')
+
+
+# Every commit that changes the database bumps the version of the library,
+# whether it's made by the indexer or through the API.
+library_version_path = get_library_version_path(app.config)
+track_library_changes(db.engine, library_version_path,
+                      ignore=is_safe_request)
+
 # RESTful API
 api = Api(app)
 
@@ -43,17 +67,52 @@ api.add_resource(resources.ClientResource, '/clients', endpoint='client')
 api.add_resource(resources.AboutResource, '/about', endpoint='about')
 
 
+# Endpoints whose responses only depend on what's in the database. They are
+# tagged with the version of the library.
+LIBRARY_ENDPOINTS = ('artist', 'album', 'track', 'lyrics', 'whatsnew')
+
+
 @app.before_request
 def before_request():
     g.db = db
 
+    if request.method in ('GET', 'HEAD') and \
+            request.endpoint in LIBRARY_ENDPOINTS:
+        version, changed = get_library_version(library_version_path)
+        g.etag = '%s-%d' % (get_version(), version)
+        # HTTP dates have no fractions of a second, so the ones sent back in
+        # If-Modified-Since must be compared without them.
+        g.last_modified = changed and \
+            datetime.utcfromtimestamp(changed).replace(microsecond=0)
+        # The client has the current version, no need to hit the database.
+        if not is_resource_modified(request.environ, etag=g.etag,
+                                    last_modified=g.last_modified):
+            # The resource, and its ``allow_origins`` decorator, are skipped.
+            if app.config.get('CORS_ENABLED') is True:
+                set_cors_origin()
+
+            return JSONResponse(304)
+
 
 @app.after_request
 def after_request(response):
     if getattr(g, 'cors', False):
         response.headers['Access-Control-Allow-Origin'] = g.cors
         response.headers['Access-Control-Allow-Headers'] = \
-            'Accept, Content-Type, Origin, X-Requested-With'
+            'Accept, Content-Type, If-Modified-Since, If-None-Match, ' \
+            'Origin, X-Requested-With'
+        response.headers['Access-Control-Expose-Headers'] = \
+            'ETag, Last-Modified, Link'
+
+    if getattr(g, 'next_page', None):
+        response.headers['Link'] = '<%s>; rel="next"' % g.next_page
+
+    if getattr(g, 'etag', None) and response.status_code in (200, 304):
+        response.set_etag(g.etag)
+        if g.last_modified:
+            response.last_modified = g.last_modified
+        # Cached responses are fine, as long as they are revalidated.
+        response.headers['Cache-Control'] = 'no-cache'
 
     return response
 
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""Indexing benchmark for the Shiva-Server API.
+Generates a reproducible library of small, tagged tracks and indexes it,
+recording the throughput and the peak memory usage of every run.
+
+Usage:
+    shiva-benchmark [-h] [--tracks=<n>] [--formats=<mix>] [--seed=<n>]
+                    [--seconds=<n>] [--cover-size=<bytes>] [--library=<dir>]
+                    [--jobs=<n>] [--output=<file>]
+
+Options:
+    -h, --help         Show this help message and exit
+    --tracks=<n>       Number of tracks in the library [default: 1000].
+    --formats=<mix>    Comma separated list of formats and their weights in
+                       the library [default: mp3:70,flac:20,ogg:10].
+    --seed=<n>         Seed for the names and tags of the library
+                       [default: 0].
+    --seconds=<n>      Length of every track, which determines the size of
+                       the files [default: 3].
+    --cover-size=<bytes>
+                       Size of the cover image embedded in every MP3 and FLAC
+                       file. 0 for none [default: 0].
+    --library=<dir>    Where to generate the library. It's reused if it was
+                       generated with the same options. Defaults to a
+                       temporary directory, removed at the end.
+    -j --jobs=<n>      Passed on to the indexer [default: 1].
+    --output=<file>    File the results are appended to, as JSON lines
+                       [default: benchmark.jsonl].
+"""
+from datetime import datetime
+from random import Random
+from time import time
+import json
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+
+from docopt import docopt
+from mutagen.easyid3 import EasyID3
+from mutagen.flac import FLAC, Picture
+from mutagen.id3 import APIC, ID3
+from mutagen.ogg import OggPage
+from mutagen.oggvorbis import OggVorbis
+
+from shiva.utils import get_logger, get_shiva_path
+
+log = get_logger()
+
+# Written in the library's root, so it can be told apart from a real one.
+MARKER = '.shiva-benchmark.json'
+SAMPLE_RATE = 44100
+
+# Indexer runs, in order. Runs marked as fresh start with an empty database.
+MODES = (
+    ('full', True, []),
+    ('orm', True, ['--no-bulk']),
+    ('incremental', False, []),
+    ('nometadata', True, ['--nometadata']),
+    ('header-only', True, ['--header-only']),
+)
+
+
+def make_mp3(path, seconds=3):
+    # MPEG-1 Layer III frames, 128kbps at 44.1kHz, of 1152 samples each.
+    frame = '\xff\xfb\x90\x00' + '\x00' * 413
+    with open(path, 'wb') as stub:
+        stub.write(frame * int(seconds * SAMPLE_RATE / 1152))
+
+    return EasyID3()
+
+
+def make_flac(path, seconds=3):
+    info = struct.pack('>HH', 4096, 4096) + '\x00' * 6
+    # 20 bits of sample rate, 3 of channels - 1, 5 of bits per sample - 1 and
+    # 36 of total samples.
+    bits = ((SAMPLE_RATE << 44) | (1 << 41) | (15 << 36) |
+            (SAMPLE_RATE * seconds))
+    info += struct.pack('>Q', bits) + '\x00' * 16
+    # The STREAMINFO block, flagged as the last one.
+    header = struct.pack('>I', (1 << 31) | len(info))
+    with open(path, 'wb') as stub:
+        stub.write('fLaC' + header + info)
+        # Roughly what 700kbps of compressed audio takes.
+        stub.write('\x00' * (seconds * 700 * 1024 / 8))
+
+    flac = FLAC(path)
+    flac.add_tags()
+
+    return flac
+
+
+def make_ogg(path, seconds=3):
+    identification = '\x01vorbis' + struct.pack(
+        '<IBIiiiBB', 0, 2, SAMPLE_RATE, 0, 128000, 0, 0xb8, 1)
+    comment = ('\x03vorbis' + struct.pack('<I', 5) + 'shiva' +
+               struct.pack('<I', 0) + '\x01')
+    setup = '\x05vorbis' + '\x00' * 32
+    # One page of 128kbps audio per second.
+    audio = '\x00' * (128 * 1024 / 8)
+
+    pages = [([identification], 0), ([comment, setup], 0)]
+    for second in xrange(1, seconds + 1):
+        pages.append(([audio], SAMPLE_RATE * second))
+    with open(path, 'wb') as stub:
+        for sequence, (packets, position) in enumerate(pages):
+            page = OggPage()
+            page.serial = 1
+            page.sequence = sequence
+            page.packets = packets
+            page.position = position
+            page.first = sequence == 0
+            page.last = sequence == len(pages) - 1
+            stub.write(page.write())
+
+    return OggVorbis(path)
+
+
+FORMATS = {
+    'mp3': make_mp3,
+    'flac': make_flac,
+    'ogg': make_ogg,
+}
+
+
+def add_cover(path, extension, size):
+    """Embeds a fake JPEG cover of the given size in an MP3 or FLAC file."""
+
+    data = '\xff\xd8\xff\xe0' + '\x00' * (size - 4)
+    if extension == 'mp3':
+        tags = ID3(path)
+        tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc=u'Cover',
+                      data=data))
+        tags.save(path)
+    elif extension == 'flac':
+        picture = Picture()
+        picture.type = 3
+        picture.mime = 'image/jpeg'
+        picture.data = data
+        flac = FLAC(path)
+        flac.add_picture(picture)
+        flac.save()
+
+
+def parse_formats(mix):
+    """
+    Parses a list like ``mp3:70,flac:30`` into a list of ``(format, weight)``
+    tuples.
+
+    """
+
+    formats = []
+    for item in mix.split(','):
+        name, _, weight = item.strip().partition(':')
+        if name not in FORMATS:
+            raise ValueError('Unknown format: %s' % name)
+
+        formats.append((name, int(weight or 1)))
+
+    return formats
+
+
+class Library(object):
+    """
+    Synthetic music collection. The same options always produce the same
+    files, with the same tags, including the things that make real
+    collections slow to index: repeated titles, accented names and albums
+    with many artists.
+
+    """
+
+    def __init__(self, root, tracks=1000, formats=None, seed=0, seconds=3,
+                 cover_size=0):
+        self.root = root
+        self.tracks = tracks
+        self.formats = formats or [('mp3', 1)]
+        self.seed = seed
+        self.seconds = seconds
+        self.cover_size = cover_size
+
+    def get_options(self):
+        return {
+            'tracks': self.tracks,
+            'formats': self.formats,
+            'seed': self.seed,
+            'seconds': self.seconds,
+            'cover_size': self.cover_size,
+        }
+
+    def is_generated(self):
+        marker = os.path.join(self.root, MARKER)
+        if not os.path.exists(marker):
+            return False
+
+        with open(marker) as _marker:
+            options = json.load(_marker)
+
+        options['formats'] = [tuple(item) for item in options['formats']]
+
+        return options == self.get_options()
+
+    def generate(self):
+        if self.is_generated():
+            log.info('Reusing library in %s' % self.root)
+
+            return None
+
+        if os.path.isdir(self.root) and os.listdir(self.root):
+            if not os.path.exists(os.path.join(self.root, MARKER)):
+                raise ValueError('%s is not empty, and was not generated by '
+                                 'shiva-benchmark.' % self.root)
+
+            shutil.rmtree(self.root)
+
+        log.info('Generating %d tracks in %s' % (self.tracks, self.root))
+        random = Random(self.seed)
+        names = [name for name, weight in self.formats for i in xrange(weight)]
+        artists = max(1, self.tracks / 30)
+        for number in xrange(self.tracks):
+            artist = u'Artist %d' % random.randint(1, artists)
+            if random.random() < 0.1:
+                artist = u'Artíst %d Café' % random.randint(1, artists)
+            album = u'Album %d' % (number / 10)
+            title = random.choice((u'Intro', u'Untitled', u'Song %d' % number,
+                                   u'Song %d' % number, u'Song %d' % number))
+            extension = random.choice(names)
+
+            directory = os.path.join(self.root, artist.encode('utf-8'),
+                                     album.encode('utf-8'))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            path = os.path.join(directory, '%05d.%s' % (number, extension))
+            audio = FORMATS[extension](path, self.seconds)
+            audio['title'] = title
+            audio['artist'] = artist
+            audio['album'] = album
+            audio['date'] = unicode(random.randint(1960, 2013))
+            audio['tracknumber'] = u'%d/10' % (number % 10 + 1)
+            audio.save(path)
+            if self.cover_size:
+                add_cover(path, extension, self.cover_size)
+
+        with open(os.path.join(self.root, MARKER), 'w') as marker:
+            json.dump(self.get_options(), marker)
+
+
+def get_revision():
+    """Returns the git revision Shiva is running from, if any."""
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=get_shiva_path(), stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark(object):
+    """
+    Runs the indexer on a library, in a separate process and with its own
+    configuration and SQLite database, once for every mode.
+
+    """
+
+    def __init__(self, library, workdir, jobs=1):
+        self.library = library
+        self.workdir = workdir
+        self.jobs = jobs
+        self.db_path = os.path.join(workdir, 'shiva.db')
+        self.config_path = os.path.join(workdir, 'config.py')
+        self.log_path = os.path.join(workdir, 'indexer.log')
+
+        with open(self.config_path, 'w') as config:
+            config.write('from shiva.media import MediaDir\n')
+            config.write('SQLALCHEMY_DATABASE_URI = %r\n' % (
+                         'sqlite:///%s' % self.db_path))
+            config.write('MEDIA_DIRS = (MediaDir(%r),)\n' % library.root)
+
+    def run_indexer(self, args):
+        """
+        Returns the exit status, elapsed time, peak RSS (in KiB) and profile
+        of an indexer run.
+
+        """
+
+        profile_path = os.path.join(self.workdir, 'profile.json')
+        if os.path.exists(profile_path):
+            os.remove(profile_path)
+
+        env = dict(os.environ,
+                   SHIVA_CONFIG=self.config_path,
+                   XDG_CONFIG_HOME=self.workdir,
+                   XDG_DATA_HOME=self.workdir)
+        command = [sys.executable, '-m', 'shiva.indexer', '--quiet',
+                   '--jobs=%d' % self.jobs,
+                   '--profile-json=%s' % profile_path] + args
+
+        with open(self.log_path, 'w') as output:
+            started = time()
+            process = subprocess.Popen(command, env=env, stdout=output,
+                                       stderr=output)
+            # Unlike getrusage(), wait4() reports on this child alone.
+            pid, status, usage = os.wait4(process.pid, 0)
+            elapsed = time() - started
+
+        profile = None
+        if os.path.exists(profile_path):
+            with open(profile_path) as _profile:
+                profile = json.load(_profile)
+
+        return os.WEXITSTATUS(status), elapsed, usage.ru_maxrss, profile
+
+    def run(self):
+        revision = get_revision()
+        for mode, fresh, args in MODES:
+            if fresh and os.path.exists(self.db_path):
+                os.remove(self.db_path)
+
+            log.info('Running %s indexing...' % mode)
+            status, elapsed, peak_rss, profile = self.run_indexer(args)
+            if status:
+                with open(self.log_path) as output:
+                    log.error('The indexer failed:\n%s' % output.read())
+
+            yield {
+                'date': datetime.utcnow().isoformat(),
+                'revision': revision,
+                'mode': mode,
+                'tracks': self.library.tracks,
+                'formats': dict(self.library.formats),
+                'seed': self.library.seed,
+                'track_seconds': self.library.seconds,
+                'cover_size': self.library.cover_size,
+                'jobs': self.jobs,
+                'exit_status': status,
+                'seconds': elapsed,
+                'tracks_per_second': self.library.tracks / elapsed,
+                'peak_rss_kb': peak_rss,
+                'profile': profile,
+            }
+
+
+def main():
+    arguments = docopt(__doc__)
+    log.setLevel(logging.INFO)
+
+    try:
+        tracks = int(arguments['--tracks'])
+        seed = int(arguments['--seed'])
+        seconds = int(arguments['--seconds'])
+        cover_size = int(arguments['--cover-size'])
+        jobs = int(arguments['--jobs'])
+        formats = parse_formats(arguments['--formats'])
+    except ValueError, e:
+        sys.stderr.write('ERROR: %s\n' % e)
+        sys.exit(1)
+
+    workdir = tempfile.mkdtemp(prefix='shiva-benchmark-')
+    root = arguments['--library'] or os.path.join(workdir, 'library')
+    library = Library(os.path.abspath(root), tracks=tracks, formats=formats,
+                      seed=seed, seconds=seconds, cover_size=cover_size)
+
+    try:
+        library.generate()
+        benchmark = Benchmark(library, workdir, jobs=jobs)
+        with open(arguments['--output'], 'a') as output:
+            for result in benchmark.run():
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+                counters = (result['profile'] or {}).get('counters', {})
+                files_read = counters.get('files_read') or 1
+                log.info('%-12s %8.2fs %8.1f tracks/s %8d KiB peak RSS '
+                         '%8.1f KiB and %.1f reads per track' % (
+                         result['mode'], result['seconds'],
+                         result['tracks_per_second'], result['peak_rss_kb'],
+                         counters.get('bytes_read', 0) / 1024.0 / files_read,
+                         counters.get('read_calls', 0) / float(files_read)))
+                rates = (result['profile'] or {}).get('cache_hit_rates', {})
+                rates = ['%s %.1f%%' % (name, rate * 100)
+                         for name, rate in sorted(rates.iteritems())
+                         if rate is not None]
+                if rates:
+                    log.info('%-12s cache hit rates: %s' % (
+                             result['mode'], ', '.join(rates)))
+    except ValueError, e:
+        sys.stderr.write('ERROR: %s\n' % e)
+        sys.exit(1)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoints of indexer runs, so a run that died half way can be resumed
+without walking again the directories it had finished.
+
+"""
+from hashlib import md5
+import json
+import os
+import threading
+
+from shiva.utils import get_data_path, get_logger
+
+log = get_logger()
+
+
+def get_checkpoint_path(database_uri, part=None):
+    """
+    Returns the path of the checkpoint file of the runs that index the given
+    part of the media dirs into the given database.
+
+    """
+
+    key = md5(repr((database_uri, part))).hexdigest()[:16]
+
+    return get_data_path('checkpoint-%s.json' % key)
+
+
+class Checkpoint(object):
+    """
+    Keeps track of the directories whose tracks, subdirectories included, are
+    all in the database, and saves them to a file every time the indexer
+    commits.
+
+    Every directory being walked holds a count of what keeps it open: its
+    listing, its subdirectories and its tracks on their way to the database.
+    Once the count drops to zero the directory is finished, and so is one of
+    the things keeping its parent open. Directories that couldn't be read
+    never finish, and neither do their parents.
+
+    The indexer walks the directories and saves the tracks from different
+    threads when more than one job is used, hence the lock.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Finished and committed directories.
+        self.done = set()
+        # Finished directories, waiting for the next commit.
+        self.finished = []
+        # Open directories, with their count and their parent.
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Loads the directories finished by a previous run. Returns False if
+        there is no checkpoint to resume from.
+
+        """
+
+        try:
+            with open(self.path) as checkpoint:
+                data = json.load(checkpoint)
+        except IOError:
+            return False
+        except ValueError:
+            log.warn('Ignoring the corrupted checkpoint %s' % self.path)
+
+            return False
+
+        self.done = set(path.encode('utf-8') for path in data['done'])
+
+        return True
+
+    def is_done(self, path):
+        return path in self.done
+
+    def open(self, path, parent=None):
+        """Starts counting for a directory, held open by its listing."""
+
+        with self.lock:
+            self.pending[path] = [1, parent]
+
+    def add(self, path, count=1):
+        with self.lock:
+            self.pending[path][0] += count
+
+    def close(self, path):
+        """
+        Releases one of the things keeping a directory open, and finishes it
+        (and maybe its parents) if that was the last one.
+
+        """
+
+        with self.lock:
+            while path in self.pending:
+                self.pending[path][0] -= 1
+                if self.pending[path][0]:
+                    break
+
+                parent = self.pending.pop(path)[1]
+                self.finished.append(path)
+                if parent is None:
+                    break
+
+                path = parent
+
+    def save(self):
+        """
+        Writes the finished directories to the checkpoint file. Call it only
+        once their tracks are committed.
+
+        """
+
+        with self.lock:
+            if not self.finished:
+                return None
+
+            self.done.update(self.finished)
+            self.finished = []
+            # Subdirectories of finished directories are skipped with them.
+            self.done = set(path for path in self.done
+                            if os.path.dirname(path) not in self.done)
+            done = []
+            for path in sorted(self.done):
+                try:
+                    done.append(path.decode('utf-8'))
+                except UnicodeDecodeError:
+                    # It will be walked again.
+                    pass
+
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as checkpoint:
+            json.dump({'done': done}, checkpoint)
+        os.rename(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -26,3 +26,23 @@ CORS_ENABLED = False
 # An specific domain: 'google.com'
 # A tuple of strings to allow multiple domains: ('google.com', 'napster.com')
 CORS_ALLOWED_ORIGINS = '*'
+
+# Last.FM, used by the indexer when the --lastfm flag is set.
+LASTFM_API_URL = 'http://ws.audioscrobbler.com/2.0/'
+# Last.FM asks not to make more than 5 requests per second.
+LASTFM_REQUESTS_PER_SECOND = 5
+LASTFM_WORKERS = 4
+LASTFM_TIMEOUT = 10  # Seconds
+LASTFM_RETRIES = 3
+# Lookups are cached in $XDG_DATA_HOME/shiva/lastfm.db unless a different path
+# is given here. Set to False to disable the cache.
+LASTFM_CACHE = None
+LASTFM_CACHE_TTL = 60 * 60 * 24 * 30  # Seconds
+# For lookups that found nothing.
+LASTFM_CACHE_NEGATIVE_TTL = 60 * 60 * 24 * 7
+
+# The version of the library, bumped every time the database changes, tags
+# the API's responses. A SQLite database keeps it next to its own file, with
+# a .version extension, unless a different path is given here. Any other
+# database requires it. The indexer and the server must use the same file.
+LIBRARY_VERSION_FILE = None
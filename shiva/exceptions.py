@@ -3,6 +3,22 @@ class MetadataManagerReadError(Exception):
     pass
 
 
+class LastFMError(Exception):
+    pass
+
+
+class ShardError(Exception):
+    pass
+
+
+class ReadLimitExceeded(Exception):
+    def __init__(self, reader, path):
+        self.reader = reader
+        msg = "Reading '%s' takes more than %d bytes" % (path, reader.limit)
+
+        super(ReadLimitExceeded, self).__init__(msg)
+
+
 class InvalidMimeTypeError(Exception):
     def __init__(self, mimetype):
         msg = "Invalid mimetype '%s'" % str(mimetype)
@@ -20,3 +36,12 @@ class NoConfigFoundError(Exception):
                '\t  $HOME/.config/shiva/config.py')
 
         super(NoConfigFoundError, self).__init__(msg)
+
+
+class LibraryVersionFileError(Exception):
+    def __init__(self, drivername):
+        msg = ("Can't tell where to keep the version of the library for a "
+               "'%s' database. Please set LIBRARY_VERSION_FILE to a path that "
+               "the indexer and the server share." % drivername)
+
+        super(LibraryVersionFileError, self).__init__(msg)
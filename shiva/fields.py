@@ -49,6 +49,13 @@ class ManyToManyField(fields.Raw):
 
 
 class ForeignKeyField(fields.Raw):
+    """
+    Nests the object referenced by a foreign key. Objects already in the
+    session, e.g. loaded beforehand with ``prefetch``, are taken from the
+    identity map instead of being queried one by one.
+
+    """
+
     def __init__(self, foreign_obj, nested):
         self.foreign_obj = foreign_obj
         self.nested = nested
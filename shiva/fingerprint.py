@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Content fingerprints of audio files. A fingerprint is a hash of a few blocks
+sampled from the audio data, leaving the tags out, so copies of the same file
+that were renamed or tagged differently get the same one.
+
+"""
+from hashlib import md5
+import os
+import struct
+
+# Blocks sampled from every file, and their size.
+BLOCKS = 16
+BLOCK_SIZE = 4096
+
+
+def get_syncsafe_int(data):
+    """Decodes the 28-bit integers used in ID3v2 headers."""
+
+    value = 0
+    for byte in data:
+        value = (value << 7) | (ord(byte) & 0x7f)
+
+    return value
+
+
+def get_flac_audio_start(_file, offset):
+    """
+    Returns the offset of the first audio frame of a FLAC stream, given the
+    offset of its metadata blocks.
+
+    """
+
+    while True:
+        _file.seek(offset)
+        header = _file.read(4)
+        if len(header) < 4:
+            return offset
+
+        length = struct.unpack('>I', '\x00' + header[1:])[0]
+        offset += 4 + length
+        # The first bit flags the last metadata block.
+        if ord(header[0]) & 0x80:
+            return offset
+
+
+def get_ogg_audio_start(_file, offset):
+    """
+    Returns the offset of the first Ogg page holding audio, skipping the
+    pages of the header packets, which carry the tags. Those have a granule
+    position of 0, or -1 when no packet ends in them.
+
+    """
+
+    while True:
+        _file.seek(offset)
+        header = _file.read(27)
+        if len(header) < 27 or header[:4] != 'OggS':
+            return offset
+
+        granule = struct.unpack('<q', header[6:14])[0]
+        if granule not in (0, -1):
+            return offset
+
+        segments = _file.read(ord(header[26]))
+        offset += 27 + len(segments) + sum(ord(size) for size in segments)
+
+
+def get_mp4_audio_bounds(_file, size):
+    """Returns the bounds of the ``mdat`` atom of an MP4 file, or None."""
+
+    offset = 0
+    while offset + 8 <= size:
+        _file.seek(offset)
+        header = _file.read(8)
+        if len(header) < 8:
+            return None
+
+        atom_size, name = struct.unpack('>I4s', header)
+        header_size = 8
+        if atom_size == 1:
+            atom_size = struct.unpack('>Q', _file.read(8))[0]
+            header_size = 16
+        elif atom_size == 0:
+            atom_size = size - offset
+
+        if atom_size < header_size:
+            return None
+
+        if name == 'mdat':
+            return offset + header_size, min(offset + atom_size, size)
+
+        offset += atom_size
+
+    return None
+
+
+def get_audio_bounds(_file, size):
+    """
+    Returns a ``(start, end, ogg)`` tuple, with the offsets of the audio data
+    of the file and whether it is an Ogg stream. ID3v2 tags at the start, and
+    APEv2 and ID3v1 tags at the end, are left out, as are the metadata blocks
+    of FLAC files, the header pages of Ogg streams and everything but the
+    ``mdat`` atom of MP4 files. Other formats are hashed as a whole.
+
+    """
+
+    start, end = 0, size
+
+    _file.seek(0)
+    header = _file.read(10)
+    if len(header) == 10 and header[:3] == 'ID3':
+        start = 10 + get_syncsafe_int(header[6:10])
+        # A footer follows the tag if the fourth bit of the flags is set.
+        if ord(header[5]) & 0x10:
+            start += 10
+
+    _file.seek(start)
+    magic = _file.read(8)
+    if magic[:4] == 'fLaC':
+        start = get_flac_audio_start(_file, start + 4)
+    elif magic[:4] == 'OggS':
+        return get_ogg_audio_start(_file, start), end, True
+    elif magic[4:] == 'ftyp':
+        bounds = get_mp4_audio_bounds(_file, size)
+        if bounds:
+            return bounds[0], bounds[1], False
+
+    if end - start >= 128:
+        _file.seek(end - 128)
+        if _file.read(3) == 'TAG':
+            end -= 128
+
+    if end - start >= 32:
+        _file.seek(end - 32)
+        footer = _file.read(32)
+        if footer[:8] == 'APETAGEX':
+            tag_size, flags = struct.unpack('<I4xI', footer[12:24])
+            end -= tag_size
+            # The header, if any, is not included in the size.
+            if flags & 0x80000000:
+                end -= 32
+
+    return start, max(start, end), False
+
+
+def read_ogg_block(_file, offset):
+    """
+    Returns up to ``BLOCK_SIZE`` bytes of the data of the first Ogg page
+    found from the given offset, without the page header. Page headers hold
+    a sequence number and a checksum that change when the tags are rewritten.
+
+    """
+
+    _file.seek(offset)
+    data = _file.read(2 * BLOCK_SIZE)
+    position = data.find('OggS')
+    if position < 0 or len(data) < position + 27:
+        return ''
+
+    segments = ord(data[position + 26])
+    start = position + 27 + segments
+    if len(data) < start:
+        return ''
+
+    page_size = sum(ord(size) for size in data[position + 27:start])
+    data = data[start:start + min(page_size, BLOCK_SIZE)]
+    missing = min(page_size, BLOCK_SIZE) - len(data)
+    if missing > 0:
+        _file.seek(offset + start + len(data))
+        data += _file.read(missing)
+
+    return data
+
+
+def get_fingerprint(path):
+    """
+    Returns the fingerprint of an audio file: a hash of the length of its
+    audio data and of ``BLOCKS`` blocks spread evenly over it. Only the tags'
+    headers and the sampled blocks are read, in order.
+
+    """
+
+    digest = md5()
+    with open(path, 'rb') as _file:
+        size = os.fstat(_file.fileno()).st_size
+        try:
+            start, end, ogg = get_audio_bounds(_file, size)
+        except struct.error:
+            start, end, ogg = 0, size, False
+
+        length = end - start
+        digest.update(str(length))
+
+        if length <= BLOCKS * BLOCK_SIZE and not ogg:
+            offsets = [start]
+            block_size = length
+        else:
+            step = max(length - BLOCK_SIZE, 0) / (BLOCKS - 1)
+            offsets = [start + i * step for i in xrange(BLOCKS)]
+            block_size = BLOCK_SIZE
+
+        for offset in offsets:
+            if ogg:
+                digest.update(read_ogg_block(_file, offset))
+            else:
+                _file.seek(offset)
+                digest.update(_file.read(block_size))
+
+    return digest.hexdigest()
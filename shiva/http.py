@@ -1,4 +1,6 @@
-from flask import current_app as app, Response
+import json
+
+from flask import current_app as app, Response, stream_with_context
 from flask.ext import restful
 
 from shiva.decorators import allow_origins
@@ -35,3 +37,37 @@ class JSONResponse(Response):
         params.update(kwargs)
 
         super(JSONResponse, self).__init__(**params)
+
+
+class JSONArrayResponse(JSONResponse):
+    """
+    A JSONResponse that streams the elements of an iterable as a JSON array,
+    encoding them as they are produced instead of building the whole array
+    first. The request context is kept around until the array ends. The
+    output is the same ``json.dumps`` would give for a list.
+
+    """
+
+    def __init__(self, elements, status=200, **kwargs):
+        kwargs['response'] = stream_with_context(self.encode(elements))
+
+        super(JSONArrayResponse, self).__init__(status, **kwargs)
+
+    @staticmethod
+    def encode(elements, chunk_size=64 * 1024):
+        """Yields the array in chunks of about ``chunk_size`` bytes."""
+
+        chunk, length = ['['], 1
+        separator = ''
+        for element in elements:
+            data = json.dumps(element)
+            chunk.extend((separator, data))
+            separator = ', '
+            length += len(data) + 2
+            if length >= chunk_size:
+                yield ''.join(chunk)
+                chunk, length = [], 0
+
+        chunk.append(']')
+
+        yield ''.join(chunk)
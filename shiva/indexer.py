@@ -5,39 +5,390 @@ pictures from Last.FM.
 
 Usage:
     shiva-indexer [-h] [-v] [-q] [--lastfm] [--nometadata] [--reindex]
-                  [--verbose-sql]
+                  [--verbose-sql] [--jobs=<n>] [--batch-size=<n>] [--watch]
+                  [--profile] [--profile-json=<file>] [--prune]
+                  [--partial-hash] [--header-only] [--readahead=<bytes>]
+                  [--read-limit=<bytes>] [--fingerprint] [--part=<k/n>]
+                  [--shard=<file>] [--resume] [--no-bulk]
+    shiva-indexer merge [-v] [-q] [--lastfm] [--nometadata] [--reindex]
+                        [--verbose-sql] [--batch-size=<n>] [--prune]
+                        [--fingerprint] [--profile] [--profile-json=<file>]
+                        [--no-bulk] <shard>...
+    shiva-indexer duplicates [-v] [-q]
 
 Options:
-    -h, --help     Show this help message and exit
-    --lastfm       Retrieve artist and album covers from Last.FM API.
-    --nometadata   Don't read file's metadata when indexing.
-    --reindex      Remove all existing data from the database before indexing.
-    --verbose-sql  Print every SQL statement. Be careful, it's a little too
-                   verbose.
-    -v --verbose   Show debugging messages about the progress.
-    -q --quiet     Suppress warnings.
+    -h, --help        Show this help message and exit
+    --lastfm          Retrieve artist and album covers from Last.FM API.
+    --nometadata      Don't read file's metadata when indexing.
+    --reindex         Remove all existing data from the database before
+                      indexing.
+    --verbose-sql     Print every SQL statement. Be careful, it's a little too
+                      verbose.
+    -j --jobs=<n>     Number of processes reading the files' metadata in
+                      parallel [default: 1].
+    --batch-size=<n>  Commit to the database every <n> tracks. Set to 0 to
+                      commit only once, at the end [default: 5000].
+    --watch           After indexing keep running, and index the changes to
+                      the media dirs as they happen. Requires Linux and
+                      pyinotify.
+    --prune           Remove from the database the tracks whose files are not
+                      in the media dirs anymore, along with the albums and
+                      artists left without tracks.
+    --partial-hash    Store a hash of the beginning and the end of every file
+                      read, to recognize moved files even if their inode
+                      changed (e.g. when moved to a different disk).
+    --fingerprint     Store a fingerprint of the audio data of every file, to
+                      find duplicates with `shiva-indexer duplicates`. Tracks
+                      indexed without one are fingerprinted too.
+    --part=<k/n>      Only index the k-th of every n media dirs, so n indexers
+                      can split them. All of them must have the same
+                      MEDIA_DIRS.
+    --shard=<file>    Write the tracks found to <file>, instead of to the
+                      database, to be loaded later with `shiva-indexer merge`.
+                      Compressed if it ends in .gz.
+    --resume          Resume the last run that didn't finish, skipping the
+                      directories it had indexed. Implies no --prune.
+    --header-only     Read the files' tags with fewer, larger and bounded
+                      reads. Meant for network filesystems.
+    --readahead=<bytes>
+                      Bytes read at once in header-only mode
+                      [default: 16384].
+    --read-limit=<bytes>
+                      Most bytes read from a file in header-only mode. Files
+                      that need more are read as usual [default: 1048576].
+    --no-bulk         Write to an empty database through the ORM too, instead
+                      of with bulk inserts. Slower, meant for comparing both.
+    --profile         Measure how long every phase of the indexing takes and
+                      print it at the end, with some counters.
+    --profile-json=<file>
+                      Like --profile, but also write the measures to <file>
+                      as JSON.
+    -v --verbose      Show debugging messages about the progress.
+    -q --quiet        Suppress warnings.
 """
 # K-Pg
+from array import array
+from bisect import bisect_left
 from datetime import datetime
+from itertools import groupby, imap
+from multiprocessing import Pool
+from operator import itemgetter
 from time import time
 import logging
 import os
 import sys
 import traceback
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
 from docopt import docopt
-from sqlalchemy import func
-from sqlalchemy.exc import OperationalError
+from sqlalchemy import String, bindparam, cast, func, select
+from sqlalchemy.exc import DBAPIError
 
 from shiva import models as m
 from shiva.app import app, db
-from shiva.exceptions import MetadataManagerReadError
-from shiva.utils import ignored, get_logger
+from shiva.checkpoint import Checkpoint, get_checkpoint_path
+from shiva.exceptions import ShardError
+from shiva.fingerprint import get_fingerprint
+from shiva.lastfm import Enricher, LastFMCache, LastFMClient, RateLimiter
+from shiva.library import bump_library_version, get_library_version_path
+from shiva.profiler import Profiler, get_read_counters
+from shiva.reader import HeaderReader
+from shiva.shard import ShardReader, ShardWriter
+from shiva.utils import (get_data_path, get_logger, get_memo_deltas,
+                         get_memo_stats, get_partial_hash, normalize_name,
+                         slugify, MetadataManager)
+from shiva.watcher import Watcher
 
 q = db.session.query
 log = get_logger()
 
 
+def read_track(record):
+    """
+    Reads the metadata of the file described by ``record``, a dict holding at
+    least its ``path``, and returns the same dict filled with plain values.
+    Being a module level function that only deals with dicts it can be run in
+    a worker process.
+
+    If the file can't be read the traceback is stored under the ``error`` key.
+    If the record has a ``timings`` dict, the time spent parsing the file and
+    its release year is stored there. If it has a ``partial_hash`` or a
+    ``fingerprint`` key, they are filled too. In header-only mode the bytes
+    read from the file are stored under ``bytes_read``.
+
+    Records of files that may be known tracks moved somewhere else are
+    returned untouched, flagged as ``unread``. Whether they were moved is
+    found out when saving them, and only then they're read if they weren't.
+
+    """
+
+    if record.get('moved_candidates'):
+        record['unread'] = True
+
+        return record
+
+    timings = record.get('timings')
+    header_reader = HeaderReader.installed
+    if header_reader:
+        bytes_read = header_reader.bytes_read
+        unbounded_reads = header_reader.unbounded_reads
+
+    try:
+        if 'partial_hash' in record:
+            record['partial_hash'] = get_partial_hash(record['path'])
+        if 'fingerprint' in record:
+            record['fingerprint'] = get_fingerprint(record['path'])
+
+        started = time()
+        meta = MetadataManager(record['path'])
+        parsed = time()
+        year = meta.release_year
+        if timings is not None:
+            timings['parse'] = parsed - started
+            timings['year'] = time() - parsed
+
+        record.update({
+            'title': meta.title,
+            'artist': meta.artist,
+            'album_artist': meta.album_artist,
+            'album': meta.album,
+            'year': year,
+            'number': meta.track_number,
+            'length': meta.length,
+            'bitrate': meta.bitrate,
+        })
+        if record.get('file_size') is None:
+            record['file_size'] = meta.filesize
+    except Exception:
+        record['error'] = traceback.format_exc()
+
+    if header_reader:
+        record['bytes_read'] = header_reader.bytes_read - bytes_read
+        if header_reader.unbounded_reads > unbounded_reads:
+            record['unbounded'] = True
+
+    return record
+
+
+def read_track_profiled(record):
+    """
+    Same as ``read_track``, but also stores under ``timings`` how long it took,
+    how many bytes were read from disk, in how many calls, and the hits and
+    misses of the memoized tag parsers.
+
+    """
+
+    record['timings'] = {}
+    memo_stats = get_memo_stats()
+    counters = get_read_counters()
+    read_track(record)
+    record['timings']['memo'] = get_memo_deltas(memo_stats)
+    if counters is not None:
+        bytes_read, read_calls = get_read_counters()
+        record['timings']['bytes_read'] = bytes_read - counters[0]
+        # Minus the one just made to read the counters.
+        record['timings']['read_calls'] = read_calls - counters[1] - 1
+
+    return record
+
+
+def fingerprint_track(track):
+    """
+    Receives a ``(pk, path)`` tuple and returns the track's primary key and
+    fingerprint, or None if the file can't be read.
+
+    """
+
+    pk, path = track
+    try:
+        return pk, get_fingerprint(path)
+    except IOError:
+        return pk, None
+
+
+class PathIndex(object):
+    """
+    Compact, read-only index of the tracks already stored in the database.
+
+    Instead of the paths themselves only their hashes are kept, in a sorted
+    array, along with the file stats stored for each of them in parallel
+    arrays. Lookups are a binary search and memory usage is a fixed amount of
+    bytes per track, no matter how long the paths are.
+
+    A hash collision can only make a new file look like a modified one, which
+    is then looked up in the database by its actual path, or keep a deleted
+    file from being pruned.
+
+    Every track found in the media dirs is marked as seen, so the ones whose
+    files are gone can be told apart at the end of the run. Tracks can also
+    be looked up by inode or by size, to find out where their files were
+    moved to. Those lookups are sorted the first time they're needed.
+
+    """
+
+    # Array typecodes for the path hash, mtime, size, inode, primary key and
+    # device. NULL values are stored as -1 (or 0, for the unsigned ones).
+    TYPECODES = ('l', 'l', 'l', 'L', 'l', 'L')
+    SIZE = 2
+    INODE = 3
+    DEVICE = 5
+
+    def __init__(self, rows=tuple()):
+        columns = [array(typecode) for typecode in self.TYPECODES]
+        hashes, mtimes, sizes, inodes, pks, devices = columns
+        for path, mtime, size, inode, pk, device in rows:
+            hashes.append(hash(path))
+            mtimes.append(-1 if mtime is None else mtime)
+            sizes.append(-1 if size is None else size)
+            inodes.append(inode or 0)
+            pks.append(pk)
+            devices.append(device or 0)
+
+        # Sort all the columns by path hash.
+        order = sorted(xrange(len(hashes)), key=hashes.__getitem__)
+        self.columns = [array(column.typecode, (column[i] for i in order))
+                        for column in columns]
+        self.hashes = self.columns[0]
+        self.pks = self.columns[4]
+        self.seen = bytearray(len(self.hashes))
+        self.by_column = {}
+
+    def find(self, path):
+        """
+        Returns the position of the given path in the index, or None if it's
+        not there.
+
+        """
+
+        _hash = hash(path)
+        position = bisect_left(self.hashes, _hash)
+        if position < len(self.hashes) and self.hashes[position] == _hash:
+            return position
+
+        return None
+
+    def get_stat(self, position):
+        """Returns the (mtime, size, inode) tuple stored for a position."""
+
+        return tuple(column[position] for column in self.columns[1:4])
+
+    def mark_seen(self, position):
+        """Marks the track at position, and any hash collision, as seen."""
+
+        _hash = self.hashes[position]
+        while position < len(self.hashes) and self.hashes[position] == _hash:
+            self.seen[position] = 1
+            position += 1
+
+    def find_by(self, column, value):
+        """
+        Yields the positions of the tracks not seen yet whose value for the
+        given column (like ``SIZE`` or ``INODE``) matches.
+
+        """
+
+        if column not in self.by_column:
+            values = self.columns[column]
+            order = sorted(xrange(len(values)), key=values.__getitem__)
+            self.by_column[column] = (
+                array(values.typecode, (values[i] for i in order)),
+                array('l', order))
+
+        values, positions = self.by_column[column]
+        index = bisect_left(values, value)
+        while index < len(values) and values[index] == value:
+            if not self.seen[positions[index]]:
+                yield positions[index]
+            index += 1
+
+    def get_unseen(self):
+        """Yields the primary key of every track not marked as seen."""
+
+        for position, seen in enumerate(self.seen):
+            if not seen:
+                yield self.pks[position]
+
+    def get_size(self):
+        """Returns the amount of memory used by the index, in bytes."""
+
+        return len(self.seen) + sum(column.itemsize * len(column)
+                                    for column in self.columns)
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+class BulkLoader(object):
+    """
+    Collects rows for the artists, albums, albumartists and tracks tables and
+    writes them with one executemany-style Core insert per table, skipping
+    the ORM's unit of work completely. Meant for populating an empty
+    database, where there's nothing to update.
+
+    Primary keys are assigned here, so rows can reference each other before
+    being written. Databases that draw them from sequences, like PostgreSQL,
+    have their sequences moved past them on every flush, so later inserts
+    through the ORM don't reuse them.
+
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.tables = (m.Artist.__table__, m.Album.__table__, m.artists,
+                       m.Track.__table__)
+        self.rows = dict((table, []) for table in self.tables)
+        self.next_pk = {}
+        for table in self.tables:
+            if 'pk' in table.c:
+                max_pk = session.execute(func.max(table.c.pk)).scalar()
+                self.next_pk[table] = (max_pk or 0) + 1
+
+    def add(self, table, **values):
+        """
+        Queues a row for insertion and returns its primary key, if the table
+        has one. Missing columns are set to NULL, with the exception of
+        ``date_added`` which defaults to today, as the models do.
+
+        """
+
+        row = dict((column.name, None) for column in table.columns)
+        row.update(values)
+        if 'date_added' in row and row['date_added'] is None:
+            row['date_added'] = datetime.today()
+
+        if table in self.next_pk:
+            row['pk'] = self.next_pk[table]
+            self.next_pk[table] += 1
+
+        self.rows[table].append(row)
+
+        return row.get('pk')
+
+    def flush(self):
+        """Inserts all the queued rows, respecting the foreign keys' order."""
+
+        for table in self.tables:
+            rows = self.rows[table]
+            if rows:
+                self.session.execute(table.insert(), rows)
+                self.rows[table] = []
+
+        if self.session.connection().dialect.name == 'postgresql':
+            self.update_sequences()
+
+    def update_sequences(self):
+        for table, next_pk in self.next_pk.iteritems():
+            # Sequences start at 1, there's nothing to do until it's used.
+            if next_pk > 1:
+                sequence = func.pg_get_serial_sequence(table.name, 'pk')
+                self.session.execute(select([func.setval(sequence,
+                                                         next_pk - 1)]))
+
+
 class Indexer(object):
 
     VALID_FILE_EXTENSIONS = (
@@ -55,12 +406,32 @@ class Indexer(object):
     )
 
     def __init__(self, config=None, use_lastfm=False, no_metadata=False,
-                 reindex=False):
+                 reindex=False, jobs=1, batch_size=0, profiler=None,
+                 partial_hash=False, header_reader=None, fingerprint=False,
+                 part=None, shard=None, checkpoint=None, use_bulk=True):
         self.config = config
         self.use_lastfm = use_lastfm
         self.no_metadata = no_metadata
         self.reindex = reindex
         self.empty_db = reindex
+        self.jobs = jobs
+        self.pool = None
+        self.batch_size = batch_size
+        self.pending_tracks = 0
+        self.bulk = None
+        self.row_count = 0
+        self.write_time = 0
+        self.profiler = profiler or Profiler(enabled=False)
+        self.partial_hash = partial_hash
+        self.fingerprint = fingerprint
+        self.part = part
+        self.shard = shard
+        self.checkpoint = checkpoint
+        self.use_bulk = use_bulk
+        self.header_reader = header_reader
+        if header_reader:
+            header_reader.install()
+        self.moved_tracks = []
 
         self.session = db.session
         self.media_dirs = config.get('MEDIA_DIRS', [])
@@ -68,27 +439,70 @@ class Indexer(object):
                                                  self.VALID_FILE_EXTENSIONS)
 
         self._ext = None
-        self._meta = None
+        self.record = None
+        self.file_path = None
         self.track_count = 0
         self.skipped_tracks = 0
+        self.unchanged_tracks = 0
+        self.moved_count = 0
+        self.bytes_read = 0
+        self.unbounded_count = 0
+        self.scanned_entries = 0
+        self.walked_dirs = []
+        self.unreadable_dirs = []
+        self.pruned_tracks = 0
+        self.pruned_albums = 0
+        self.pruned_artists = 0
+        self.pruned_dirs = 0
+        self.resumed_dirs = 0
+        self.saved_stats = 0
+        self.fingerprinted = 0
         self.count_by_extension = {}
         for extension in self.allowed_extensions:
             self.count_by_extension[extension] = 0
 
+        # Only primary keys are cached, so the instances can be expunged
+        # from the session after every commit. Artists are keyed by their
+        # normalized name, and albums by their normalized name and the
+        # primary key of the album artist.
         self.artists = {}
         self.albums = {}
+        self.album_artists = set()
 
-        if self.use_lastfm:
-            import pylast
+        # Primary keys of the artists, and of the albums along with their
+        # album artist's, still waiting for their Last.FM information.
+        self.new_artists = []
+        self.new_albums = []
 
-            self.pylast = pylast
-            api_key = config['LASTFM_API_KEY']
-            self.lastfm = self.pylast.LastFMNetwork(api_key=api_key)
+        if self.use_lastfm:
+            rate = config.get('LASTFM_REQUESTS_PER_SECOND')
+            rate_limiter = RateLimiter(rate)
+            self.lastfm = LastFMClient(config['LASTFM_API_KEY'],
+                                       api_url=config.get('LASTFM_API_URL'),
+                                       timeout=config.get('LASTFM_TIMEOUT'),
+                                       retries=config.get('LASTFM_RETRIES', 0),
+                                       rate_limiter=rate_limiter)
+            cache = None
+            cache_path = config.get('LASTFM_CACHE')
+            if cache_path is not False:
+                cache = LastFMCache(
+                    cache_path or get_data_path('lastfm.db'),
+                    ttl=config.get('LASTFM_CACHE_TTL'),
+                    negative_ttl=config.get('LASTFM_CACHE_NEGATIVE_TTL'))
+            self.enricher = Enricher(self.lastfm,
+                                     workers=config.get('LASTFM_WORKERS', 1),
+                                     cache=cache)
 
         if not len(self.media_dirs):
             log.error("Remember to set the MEDIA_DIRS option, otherwise I "
                       "don't know where to look for.")
 
+        # Shards are written without ever touching the database.
+        if self.shard:
+            self.path_index = PathIndex()
+
+            return None
+
         if reindex:
             log.info('Dropping database...')
 
@@ -102,99 +516,469 @@ class Indexer(object):
 
             log.info('Recreating database...')
             db.create_all()
+            # Commits are tracked by shiva.app, but this is not one.
+            bump_library_version(get_library_version_path(config))
 
         # This is useful to know if the DB is empty, and avoid some checks
         if not self.reindex:
             try:
-                m.Artist.query.limit(1).all()
-            except OperationalError:
+                self.empty_db = q(m.Track.pk).first() is None
+            except DBAPIError:
+                # PostgreSQL refuses any other statement in the transaction
+                # after an error.
+                self.session.rollback()
                 self.empty_db = True
 
+        self.path_index = self.load_path_index()
+        if not self.reindex:
+            self.load_artists_and_albums()
+
+        # There is nothing to update in an empty DB, rows can be bulk inserted.
+        if self.empty_db and self.use_bulk:
+            self.bulk = BulkLoader(self.session)
+
+    def load_path_index(self):
+        """
+        Loads the path, mtime, size and inode of every indexed track, in a
+        single query, into a ``PathIndex``. This allows to tell new and
+        unchanged files apart without querying the database for each one.
+
+        """
+
+        if self.empty_db:
+            return PathIndex()
+
+        query = q(m.Track.path, m.Track.mtime, m.Track.file_size,
+                  m.Track.inode, m.Track.pk, m.Track.device).yield_per(5000)
+        try:
+            # The query is executed as soon as the generator is created.
+            rows = ((path.encode('utf-8'), mtime, size, inode, pk, device)
+                    for path, mtime, size, inode, pk, device in query)
+            path_index = PathIndex(rows)
+        except DBAPIError:
+            # Missing columns are an OperationalError in SQLite, but a
+            # ProgrammingError in PostgreSQL.
+            self.session.rollback()
+            log.error('Your database was created by an older version of '
+                      'Shiva. Please run the indexer with --reindex.')
+            sys.exit(1)
+
+        log.info('Loaded %d known tracks (%.1f MiB).' % (
+                 len(path_index), path_index.get_size() / 1024.0 / 1024))
+
+        return path_index
+
+    def load_artists_and_albums(self):
+        """
+        Loads the primary keys of the artists and albums already in the
+        database, and the links between them, so each track's artist and
+        album can be found without a query and are never created twice.
+
+        """
+
+        query = q(m.Artist.pk, m.Artist.name).order_by(m.Artist.pk)
+        for pk, name in query.yield_per(5000):
+            self.artists.setdefault(normalize_name(name), pk)
+
+        names = dict(q(m.Album.pk, m.Album.name))
+        links = m.artists
+        query = self.session.execute(
+            select([links.c.album_pk, links.c.artist_pk]).
+            order_by(links.c.album_pk))
+        for album_pk, artist_pk in query:
+            self.album_artists.add((album_pk, artist_pk))
+            if album_pk in names:
+                key = (normalize_name(names[album_pk]), artist_pk)
+                self.albums.setdefault(key, album_pk)
+
+        if self.artists:
+            log.info('Loaded %d known artists and %d albums.' % (
+                     len(self.artists), len(names)))
+
     def get_artist(self, name):
+        """Returns the primary key of the artist, creating it if needed."""
+
         name = name.strip() if type(name) in (str, unicode) else None
         if not name:
             return None
 
-        if name in self.artists:
-            return self.artists[name]
+        key = normalize_name(name)
+        if key in self.artists:
+            return self.artists[key]
         else:
-            cover = None
+            if self.bulk:
+                artist_pk = self.bulk.add(m.Artist.__table__, name=name,
+                                          slug=slugify(name))
+            else:
+                artist = m.Artist(name=name)
+                self.session.add(artist)
+                self.session.flush()
+                artist_pk = artist.pk
+
+            self.artists[key] = artist_pk
+            self.row_count += 1
             if self.use_lastfm:
-                log.debug('[ Last.FM ] Retrieving "%s" info' % name)
-                with ignored(Exception, print_traceback=True):
-                    cover = self.lastfm.get_artist(name).get_cover_image()
-            artist = m.Artist(name=name, image=cover)
-            self.session.add(artist)
-            self.artists[name] = artist
+                self.new_artists.append(artist_pk)
+
+        return artist_pk
 
-        return artist
+    def get_album(self, name, artist_pk):
+        """
+        Returns the primary key of the album by the given album artist,
+        creating it if needed.
+
+        """
 
-    def get_album(self, name, artist):
         name = name.strip() if type(name) in (str, unicode) else None
-        if not name or not artist:
+        if not name or not artist_pk:
             return None
 
-        if name in self.albums:
-            return self.albums[name]
+        key = (normalize_name(name), artist_pk)
+        if key in self.albums:
+            return self.albums[key]
         else:
-            release_year = self.get_release_year()
-            cover = None
+            release_year = self.record['year']
+            if self.bulk:
+                album_pk = self.bulk.add(m.Album.__table__, name=name,
+                                         slug=slugify(name), year=release_year)
+            else:
+                album = m.Album(name=name, year=release_year)
+                self.session.add(album)
+                self.session.flush()
+                album_pk = album.pk
+
+            self.albums[key] = album_pk
+            self.row_count += 1
             if self.use_lastfm:
-                log.debug('[ Last.FM ] Retrieving album "%s" by "%s"' % (
-                          name, artist.name))
-                with ignored(Exception, print_traceback=True):
-                    _artist = self.lastfm.get_artist(artist.name)
-                    _album = self.lastfm.get_album(_artist, name)
-                    release_year = self.get_release_year(_album)
-                    pylast_cover = self.pylast.COVER_EXTRA_LARGE
-                    cover = _album.get_cover_image(size=pylast_cover)
+                self.new_albums.append((album_pk, artist_pk))
 
-            album = m.Album(name=name, year=release_year, cover=cover)
-            self.session.add(album)
-            self.albums[name] = album
+        return album_pk
 
-        return album
+    def add_album_artist(self, album_pk, artist_pk):
+        """Links an artist to an album, unless they are already linked."""
 
-    def get_release_year(self, lastfm_album=None):
-        if not self.use_lastfm or not lastfm_album:
-            return self.get_metadata_reader().release_year
+        if (album_pk, artist_pk) in self.album_artists:
+            return False
 
-        _date = lastfm_album.get_release_date()
-        if not _date:
-            if not self.get_metadata_reader().release_year:
-                return None
+        if self.bulk:
+            self.bulk.add(m.artists, album_pk=album_pk, artist_pk=artist_pk)
+        else:
+            self.session.execute(m.artists.insert().values(
+                album_pk=album_pk, artist_pk=artist_pk))
+
+        self.album_artists.add((album_pk, artist_pk))
+        self.row_count += 1
 
-            return self.get_metadata_reader().release_year
+        return True
 
-        return datetime.strptime(_date, '%d %b %Y, %H:%M').year
+    def add_track(self, values):
+        """
+        Stores a track, given the values of its columns. Tracks are either
+        added to the session, or queued in the bulk loader if the DB was
+        empty.
+
+        """
+
+        values['last_indexed'] = datetime.now()
+        if self.bulk:
+            if 'title' in values:
+                values['slug'] = slugify(values['title'])
+            self.bulk.add(m.Track.__table__, **values)
+        else:
+            track = None
+            if self.record.get('modified'):
+                track = q(m.Track).filter_by(path=values['path']).first()
+
+            if track is None:
+                track = m.Track(values['path'], no_metadata=True)
+
+            for attr, value in values.iteritems():
+                setattr(track, attr, value)
+
+            self.session.add(track)
 
-    def add_to_session(self, track):
-        self.session.add(track)
         ext = self.get_extension()
         self.count_by_extension[ext] += 1
+        self.row_count += 1
 
-        log.info('[ OK ] %s' % track.path)
+        log.info('[ OK ] %s' % values['path'])
+
+        self.pending_tracks += 1
 
         return True
 
-    def skip(self, reason=None, print_traceback=None):
+    def enrich(self, chunk_size=500):
+        """
+        Retrieves the image of every new artist, and the cover and release
+        year of every new album, from Last.FM. The requests are issued
+        concurrently, and rate limited, but the database is only updated from
+        this thread.
+
+        """
+
+        if not self.use_lastfm:
+            return None
+
+        artist_pks, self.new_artists = self.new_artists, []
+        albums, self.new_albums = self.new_albums, []
+
+        jobs = []
+        for i in xrange(0, len(artist_pks), chunk_size):
+            chunk = artist_pks[i:i + chunk_size]
+            query = q(m.Artist.pk, m.Artist.name).\
+                filter(m.Artist.pk.in_(chunk))
+            for pk, name in query:
+                jobs.append((('artist', pk), 'get_artist', (name,)))
+
+        for i in xrange(0, len(albums), chunk_size):
+            # The album artist of each album.
+            chunk = dict(albums[i:i + chunk_size])
+            query = q(m.Album.pk, m.Album.name, m.Artist.pk, m.Artist.name).\
+                join(m.artists, m.artists.c.album_pk == m.Album.pk).\
+                join(m.Artist, m.Artist.pk == m.artists.c.artist_pk).\
+                filter(m.Album.pk.in_(chunk))
+            for pk, name, artist_pk, artist_name in query:
+                # Albums are linked to the artist of every track too, which
+                # for compilations would be a different one for each.
+                if artist_pk == chunk[pk]:
+                    jobs.append((('album', pk), 'get_album',
+                                 (artist_name, name)))
+
+        if not jobs:
+            return None
+
+        log.info('[ Last.FM ] Retrieving info for %d artists and albums...' %
+                 len(jobs))
+
+        artists = m.Artist.__table__
+        update_artist = artists.update().\
+            where(artists.c.pk == bindparam('_pk')).\
+            values(image=bindparam('image'))
+
+        # Keep the year read from the tags if Last.FM doesn't know it.
+        albums = m.Album.__table__
+        update_album = albums.update().\
+            where(albums.c.pk == bindparam('_pk')).\
+            values(cover=bindparam('cover'),
+                   year=func.coalesce(bindparam('year'), albums.c.year))
+
+        artist_rows, album_rows = [], []
+        for (kind, pk), info in self.enricher.fetch(jobs):
+            if info and kind == 'artist' and info['image']:
+                artist_rows.append({'_pk': pk, 'image': info['image']})
+            elif info and kind == 'album' and (info['cover'] or info['year']):
+                info['_pk'] = pk
+                album_rows.append(info)
+
+            if len(artist_rows) + len(album_rows) >= 100:
+                self.update_rows(update_artist, artist_rows)
+                self.update_rows(update_album, album_rows)
+                artist_rows, album_rows = [], []
+
+        self.update_rows(update_artist, artist_rows)
+        self.update_rows(update_album, album_rows)
+
+    def update_rows(self, query, rows):
+        if rows:
+            self.session.execute(query, rows)
+            self.session.commit()
+
+    def delete_tracks(self, pks, chunk_size=500):
+        """
+        Deletes the given tracks, and their cached lyrics, in chunks. Then
+        deletes the albums and artists they leave without tracks, and the
+        albumartists links left without tracks.
+
+        """
+
+        pks = list(pks)
+        album_pks = set()
+        artist_pks = set()
+        links = set()
+        for i in xrange(0, len(pks), chunk_size):
+            chunk = pks[i:i + chunk_size]
+            query = q(m.Track.album_pk, m.Track.artist_pk).\
+                filter(m.Track.pk.in_(chunk))
+            for album_pk, artist_pk in query:
+                album_pks.add(album_pk)
+                artist_pks.add(artist_pk)
+                if album_pk and artist_pk:
+                    links.add((album_pk, artist_pk))
+
+            q(m.LyricsCache).filter(m.LyricsCache.track_pk.in_(chunk)).\
+                delete(synchronize_session=False)
+            q(m.Track).filter(m.Track.pk.in_(chunk)).\
+                delete(synchronize_session=False)
+
+        album_pks.discard(None)
+        artist_pks.discard(None)
+        self.delete_unused_links(links, chunk_size)
+        self.delete_empty(m.Album, album_pks, m.artists.c.album_pk,
+                          chunk_size)
+        self.delete_empty(m.Artist, artist_pks, m.artists.c.artist_pk,
+                          chunk_size)
+
+    def delete_unused_links(self, links, chunk_size=500):
+        """
+        Deletes the given ``(album_pk, artist_pk)`` albumartists links if no
+        track of that artist in that album is left.
+
+        """
+
+        tracks = m.Track.__table__
+        table = m.artists
+        links = sorted(links)
+        unused = []
+        for i in xrange(0, len(links), chunk_size):
+            chunk = links[i:i + chunk_size]
+            query = select([tracks.c.album_pk, tracks.c.artist_pk]).\
+                distinct().\
+                where(tracks.c.album_pk.in_(set(link[0] for link in chunk)))
+            used = set(tuple(row) for row in self.session.execute(query))
+            unused.extend(link for link in chunk if link not in used)
+
+        for album_pk, artist_pk in unused:
+            self.album_artists.discard((album_pk, artist_pk))
+
+        if unused:
+            query = table.delete().where(
+                (table.c.album_pk == bindparam('_album_pk')) &
+                (table.c.artist_pk == bindparam('_artist_pk')))
+            self.session.execute(query, [
+                {'_album_pk': album_pk, '_artist_pk': artist_pk}
+                for album_pk, artist_pk in unused])
+
+    def delete_empty(self, model, pks, link_column, chunk_size=500):
+        """
+        Deletes, along with their albumartists links, the albums or artists
+        among the given ones that have no tracks.
+
+        """
+
+        tracks = m.Track.__table__
+        track_column = tracks.c[link_column.name]
+        table = model.__table__
+        links = m.artists
+        pks = list(pks)
+        deleted = []
+        for i in xrange(0, len(pks), chunk_size):
+            chunk = pks[i:i + chunk_size]
+            query = select([track_column]).distinct().\
+                where(track_column.in_(chunk))
+            used = set(pk for pk, in self.session.execute(query))
+            empty = [pk for pk in chunk if pk not in used]
+            if not empty:
+                continue
+
+            self.session.execute(links.delete().where(link_column.in_(empty)))
+            self.session.execute(table.delete().where(table.c.pk.in_(empty)))
+            deleted.extend(empty)
+
+        if not deleted:
+            return None
+
+        log.debug('Deleted %d empty %s.' % (len(deleted),
+                                            model.__tablename__))
+        # Don't hand out the primary keys of the deleted rows anymore.
+        deleted = set(deleted)
+        if model is m.Album:
+            self.pruned_albums += len(deleted)
+            self.albums = dict((key, pk) for key, pk in
+                               self.albums.iteritems() if pk not in deleted)
+            self.album_artists = set(pair for pair in self.album_artists
+                                     if pair[0] not in deleted)
+        else:
+            self.pruned_artists += len(deleted)
+            self.artists = dict((key, pk) for key, pk in
+                                self.artists.iteritems() if pk not in deleted)
+            self.albums = dict((key, pk) for key, pk in
+                               self.albums.iteritems()
+                               if key[1] not in deleted)
+            self.album_artists = set(pair for pair in self.album_artists
+                                     if pair[1] not in deleted)
+
+    def prune(self, chunk_size=500):
+        """
+        Deletes the tracks whose files were not found while walking the media
+        dirs, with the albums and artists left without tracks.
+
+        Tracks are only pruned from the media dirs that were actually walked
+        and weren't empty, and never from directories that couldn't be read,
+        so an unmounted disk doesn't empty the database.
+
+        """
+
+        pks = list(self.path_index.get_unseen())
+        if not pks:
+            return None
+
+        roots = tuple(os.path.normpath(path) + os.sep
+                      for path in self.walked_dirs)
+        unreadable = tuple(path + os.sep for path in self.unreadable_dirs)
+
+        orphans = []
+        for i in xrange(0, len(pks), chunk_size):
+            chunk = pks[i:i + chunk_size]
+            query = q(m.Track.pk, m.Track.path).filter(m.Track.pk.in_(chunk))
+            for pk, path in query:
+                path = path.encode('utf-8')
+                if path.startswith(roots) and not path.startswith(unreadable):
+                    log.debug('[ PRUNED ] %s' % path)
+                    orphans.append(pk)
+
+        if orphans:
+            log.info('Pruning %d tracks whose files are gone...' % (
+                     len(orphans)))
+            self.delete_tracks(orphans, chunk_size)
+            self.pruned_tracks += len(orphans)
+
+    def commit(self):
+        """
+        Writes the pending tracks to the database and removes every instance
+        from the session, so memory usage doesn't grow with the size of the
+        collection.
+
+        """
+
+        log.debug('Writing %d tracks to database...' % self.pending_tracks)
+        started = time()
+        with self.profiler.phase('commit'):
+            if self.moved_tracks:
+                table = m.Track.__table__
+                query = table.update().where(table.c.pk == bindparam('_pk'))
+                self.session.execute(query, self.moved_tracks)
+                self.moved_tracks = []
+            if self.bulk:
+                self.bulk.flush()
+            self.session.commit()
+            self.session.expunge_all()
+            if self.checkpoint:
+                self.checkpoint.save()
+        self.profiler.count('commits')
+        self.pending_tracks = 0
+        self.write_time += time() - started
+
+    def skip(self, reason=None, print_traceback=None, tb=None):
         self.skipped_tracks += 1
 
         if log.getEffectiveLevel() <= logging.INFO:
             _reason = ' (%s)' % reason if reason else ''
             log.info('[ SKIPPED ] %s%s' % (self.file_path, _reason))
             if print_traceback:
-                log.info(traceback.format_exc())
+                log.info(tb or traceback.format_exc())
 
         return True
 
-    def save_track(self):
+    def save_track(self, record):
         """
-        Takes a path to a track, reads its metadata and stores everything in
-        the database.
+        Takes a record, as returned by ``read_track``, and stores the track it
+        describes in the database along with its artist and album.
 
         """
 
+        self.record = record
+        self.file_path = record['path']
+
         try:
             full_path = self.file_path.decode('utf-8')
         except UnicodeDecodeError:
@@ -203,111 +987,506 @@ class Indexer(object):
             # If file name is in an strange encoding ignore it.
             return False
 
-        try:
-            track = m.Track(full_path, no_metadata=self.no_metadata)
-        except MetadataManagerReadError:
-            self.skip('Corrupted file', print_traceback=True)
+        if record.get('moved_candidates'):
+            self.check_moved(record)
+
+        if 'error' in record:
+            self.skip('Corrupted file', print_traceback=True,
+                      tb=record['error'])
 
             # If the metadata manager can't read the file, it's probably not an
             # actual music file, or it's corrupted. Ignore it.
             return False
 
-        if not self.empty_db:
-            if q(m.Track).filter_by(path=full_path).count():
-                self.skip()
+        if self.shard:
+            self.shard.add(record, full_path)
+            self.count_by_extension[self.get_extension()] += 1
+            log.info('[ OK ] %s' % full_path)
+
+            return True
+
+        values = {'path': full_path}
+        for attr in ('mtime', 'file_size', 'inode', 'device'):
+            values[attr] = record[attr]
 
-                return True
+        if record.get('moved_pk'):
+            self.move_track(record, values)
+
+            return True
+
+        for attr in ('partial_hash', 'fingerprint'):
+            if attr in record:
+                values[attr] = record[attr]
 
         if self.no_metadata:
-            self.add_to_session(track)
+            self.add_track(values)
 
             return True
 
-        meta = self.set_metadata_reader(track)
+        for attr in ('title', 'bitrate', 'length', 'number'):
+            values[attr] = record[attr]
+
+        artist_pk = self.get_artist(record['artist'])
+        # Compilations are kept together by their album artist tag.
+        album_artist_pk = self.get_artist(record.get('album_artist'))
+        if album_artist_pk is None:
+            album_artist_pk = artist_pk
+        album_pk = self.get_album(record['album'], album_artist_pk)
+
+        if album_pk is not None:
+            for pk in set((artist_pk, album_artist_pk)):
+                if pk is not None:
+                    self.add_album_artist(album_pk, pk)
+
+        values['album_pk'] = album_pk
+        values['artist_pk'] = artist_pk
+        self.add_track(values)
+
+    def move_track(self, record, values):
+        """
+        Queues the update of the path and file stats of a moved track. Its
+        primary key, slug and everything else stay the same.
+
+        """
+
+        values['_pk'] = record['moved_pk']
+        values['last_indexed'] = datetime.now()
+        self.moved_tracks.append(values)
+        self.moved_count += 1
+        self.row_count += 1
+        self.pending_tracks += 1
+
+        log.info('[ MOVED ] %s -> %s' % (record['moved_from'],
+                                         self.file_path))
+
+    def check_moved(self, record):
+        """
+        Finds out whether the record's file is a known track that was moved,
+        see ``find_moved``, and flags it as such. Otherwise it's a new track,
+        and its metadata is read now if it wasn't already.
+
+        """
+
+        candidates, by_hash = record.pop('moved_candidates')
+        moved = self.find_moved(record, candidates, by_hash)
+        if moved:
+            position, record['moved_from'] = moved
+            # It's taken, and its file is gone anyway.
+            self.path_index.seen[position] = 1
+            record['moved_pk'] = self.path_index.pks[position]
+        elif record.pop('unread', False):
+            read_track(record)
+
+    def find_move_candidates(self, record):
+        """
+        Returns the positions in the path index of the known tracks, not seen
+        yet, that the given new file could be: the ones with the same device,
+        inode, size and mtime or, if there's none and partial hashes are
+        enabled, the ones with the same size. Also returns whether they were
+        found by size, and have to be compared by partial hash.
+
+        Only the path index is looked at, so this is safe to call from any
+        thread.
+
+        """
+
+        index = self.path_index
+        stat = (record['mtime'], record['file_size'], record['inode'])
+        devices = index.columns[index.DEVICE]
+        candidates = [position for position in
+                      index.find_by(index.INODE, record['inode'])
+                      if index.get_stat(position) == stat and
+                      devices[position] == record['device']]
+        by_hash = not candidates and self.partial_hash
+        if by_hash:
+            candidates = list(index.find_by(index.SIZE, record['file_size']))
+
+        return candidates, by_hash
+
+    def find_moved(self, record, candidates, by_hash):
+        """
+        Looks, among the candidates found by ``find_move_candidates``, for a
+        known track whose file is gone and is the same as the given new one,
+        just moved or renamed. Returns the track's position in the path index,
+        and its old path, or None.
+
+        """
+
+        index = self.path_index
+        partial_hash = None
+        for position in candidates:
+            # Taken by another file since it became a candidate.
+            if index.seen[position]:
+                continue
+
+            track = q(m.Track.path, m.Track.partial_hash).\
+                filter_by(pk=index.pks[position]).first()
+            if track is None:
+                continue
 
-        artist = self.get_artist(meta.artist)
-        album = self.get_album(meta.album, artist)
+            old_path = track.path.encode('utf-8')
+            if os.path.lexists(old_path):
+                # Not moved, but hard linked or copied.
+                continue
 
-        if artist is not None and album is not None:
-            if artist not in album.artists:
-                album.artists.append(artist)
+            if by_hash:
+                if track.partial_hash is None:
+                    continue
 
-        track.album = album
-        track.artist = artist
-        self.add_to_session(track)
+                if partial_hash is None:
+                    try:
+                        partial_hash = get_partial_hash(record['path'])
+                    except IOError:
+                        return None
 
-    def get_metadata_reader(self):
-        return self._meta
+                if partial_hash != track.partial_hash:
+                    continue
 
-    def set_metadata_reader(self, track):
-        self._meta = track.get_metadata_reader()
+            return position, old_path
 
-        return self._meta
+        return None
 
-    def get_extension(self):
-        return self.file_path.rsplit('.', 1)[1].lower()
+    def get_extension(self, path=None):
+        return (path or self.file_path).rsplit('.', 1)[1].lower()
 
-    def is_track(self):
+    def is_track(self, path):
         """Try to guess whether the file is a valid track or not."""
-        if not os.path.isfile(self.file_path):
+        if not os.path.isfile(path):
             return False
 
-        if '.' not in self.file_path:
+        return self.has_track_extension(path)
+
+    def has_track_extension(self, path):
+        if '.' not in path:
             return False
 
-        ext = self.get_extension()
+        ext = self.get_extension(path)
         if ext not in self.VALID_FILE_EXTENSIONS:
-            log.debug('[ SKIPPED ] %s (Unrecognized extension)' %
-                      self.file_path)
+            log.debug('[ SKIPPED ] %s (Unrecognized extension)' % path)
 
             return False
         elif ext not in self.allowed_extensions:
-            log.debug('[ SKIPPED ] %s (Ignored extension)' % self.file_path)
+            log.debug('[ SKIPPED ] %s (Ignored extension)' % path)
 
             return False
 
         return True
 
     def walk(self, target, exclude=tuple()):
-        """Recursively walks through a directory looking for tracks."""
+        """
+        Recursively walks through a directory looking for tracks, without
+        descending into the excluded ones. Yields a ``(path, stat)`` tuple for
+        every track found.
+
+        The type of every entry comes with the directory listing, so only the
+        tracks are stat'ed, and only once.
+
+        With a checkpoint, the directories finished by a previous run are
+        skipped, and the ones walked are counted so they can be checked off
+        once their tracks are committed.
+
+        """
 
         if not os.path.isdir(target):
-            return False
+            return
+
+        checkpoint = self.checkpoint
+        target = os.path.normpath(target)
+        exclude = set(os.path.normpath(path) for path in exclude)
+        pending = [target]
+        while pending:
+            root = pending.pop()
+            parent = os.path.dirname(root) if root != target else None
+            if root in exclude:
+                log.debug('[ EXCLUDED ] %s' % root)
+                self.pruned_dirs += 1
+                if checkpoint and parent:
+                    checkpoint.close(parent)
+
+                continue
+
+            if checkpoint and checkpoint.is_done(root):
+                log.debug('[ RESUMED ] %s' % root)
+                self.resumed_dirs += 1
+                if parent:
+                    checkpoint.close(parent)
+
+                continue
+
+            try:
+                entries = scandir(root)
+            except OSError, e:
+                log.warn('[ SKIPPED ] %s (%s)' % (root, e.strerror))
+                self.unreadable_dirs.append(root)
+
+                continue
+
+            if checkpoint:
+                checkpoint.open(root, parent)
+
+            dirs = []
+            for entry in entries:
+                self.scanned_entries += 1
+                # The stat os.walk() needed to tell directories apart.
+                self.saved_stats += 1
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+
+                    continue
+
+                # And the one is_track() needed to tell files apart.
+                self.saved_stats += 1
+                if not entry.is_file():
+                    continue
+
+                if not self.has_track_extension(entry.path):
+                    continue
+
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    log.debug('[ SKIPPED ] %s (Vanished)' % entry.path)
+
+                    continue
+
+                self.track_count += 1
+                yield entry.path, stat
+
+            if checkpoint:
+                checkpoint.add(root, len(dirs))
+                checkpoint.close(root)
+
+            # Depth first, in the order they were listed.
+            pending.extend(reversed(dirs))
+
+    def find_tracks(self):
+        """
+        Yields a ``(path, stat)`` tuple for every track found in the media
+        dirs.
+
+        """
+
+        for mobject, mdir in self.get_media_dirs():
+            if not mobject._is_valid_path(mdir):
+                continue
+
+            entries = self.scanned_entries + self.resumed_dirs
+            for track in self.walk(mdir, exclude=mobject.get_excluded_dirs()):
+                yield track
+
+            # An unmounted disk leaves an empty mount point behind, which must
+            # not be taken as a media dir whose tracks were all deleted.
+            if self.scanned_entries + self.resumed_dirs > entries:
+                self.walked_dirs.append(mdir)
+            else:
+                log.warn("Path '%s' is empty. Ignoring." % mdir)
+
+    def get_media_dirs(self):
+        """
+        Returns a ``(media_dir, path)`` tuple for every directory to walk. If
+        only the k-th part out of n was requested, that's every n-th
+        directory starting with the k-th. Directories are counted whether they
+        exist or not, so indexers on different machines split them the same
+        way.
+
+        """
+
+        dirs = [(mobject, mdir) for mobject in self.media_dirs
+                for mdir in mobject.get_dirs()]
+        if self.part:
+            k, n = self.part
+            dirs = dirs[k - 1::n]
+
+        return dirs
+
+    def stat_tracks(self, tracks):
+        """
+        Receives ``(path, stat)`` tuples and yields a record for the tracks
+        that are new or that were modified since they were last indexed.
+        Unchanged tracks are counted, but neither read nor written again. If
+        ``stat`` is None the path is stat'ed here.
+
+        """
+
+        for path, stat in tracks:
+            if stat is None:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    log.debug('[ SKIPPED ] %s (Vanished)' % path)
+                    continue
+
+            record = {
+                'path': path,
+                'mtime': int(stat.st_mtime),
+                'file_size': stat.st_size,
+                'inode': stat.st_ino,
+                'device': stat.st_dev,
+            }
+            if self.partial_hash:
+                record['partial_hash'] = None
+            if self.fingerprint:
+                record['fingerprint'] = None
+
+            if self.check_record(record):
+                # The track's directory is open until the track is saved.
+                if self.checkpoint:
+                    self.checkpoint.add(os.path.dirname(path))
+
+                yield record
+
+    def check_record(self, record):
+        """
+        Looks up the track described by the record in the path index. Returns
+        False if it's unchanged, or True if it must be saved, in which case
+        the record is flagged as ``modified``, or gets the candidates to be
+        the known track it was moved from if it's a new path.
+
+        The records of the tracks walked are checked in the thread that feeds
+        the worker processes, so the database is not queried here.
+
+        """
+
+        path = record['path']
+        position = self.path_index.find(path)
+        if position is not None:
+            self.path_index.mark_seen(position)
+            stat = self.path_index.get_stat(position)
+            if stat == (record['mtime'], record['file_size'],
+                        record['inode']):
+                self.unchanged_tracks += 1
+                log.debug('[ UNCHANGED ] %s' % path)
+
+                return False
 
-        for root, dirs, files in os.walk(target, exclude):
-            for name in files:
-                self.file_path = os.path.join(root, name)
-                if root in exclude:
-                    log.debug('[ EXCLUDED ] %s' % self.file_path)
+            record['modified'] = True
+        elif len(self.path_index):
+            candidates, by_hash = self.find_move_candidates(record)
+            if candidates:
+                record['moved_candidates'] = (candidates, by_hash)
+
+        return True
+
+    def read_shards(self, paths):
+        """
+        Yields the records, from the given shards, of the tracks that must be
+        saved, see ``check_record``. The media dirs walked to write the shards
+        are taken as walked by this indexer, so they can be pruned.
+
+        """
+
+        for path in paths:
+            log.info('Merging %s...' % path)
+            shard = ShardReader(path)
+            for record in shard:
+                if shard.header['no_metadata'] and not self.no_metadata:
+                    raise ShardError('%s was written with --nometadata, '
+                                     'merge it with --nometadata too.' % path)
+
+                if self.check_record(record):
+                    yield record
+
+            footer = shard.footer
+            self.track_count += footer['track_count']
+            self.skipped_tracks += footer['skipped_tracks']
+            self.walked_dirs.extend(_path.encode('utf-8')
+                                    for _path in footer['walked_dirs'])
+            self.unreadable_dirs.extend(_path.encode('utf-8')
+                                        for _path in footer['unreadable_dirs'])
+
+    def close_shard(self):
+        """Writes the footer of the shard, which completes it."""
+
+        self.shard.close(track_count=self.track_count,
+                         skipped_tracks=self.skipped_tracks,
+                         walked_dirs=self.walked_dirs,
+                         unreadable_dirs=self.unreadable_dirs)
+
+    def read_tracks(self, records):
+        """
+        Fills every record with the track's metadata, see ``read_track``. When
+        more than one job was requested the files are read by a pool of
+        worker processes, while the records are still consumed, and written
+        to the database, by this single process.
+
+        """
+
+        if self.no_metadata:
+            return records
+
+        _read_track = read_track
+        if self.profiler.enabled:
+            _read_track = read_track_profiled
+
+        if self.jobs > 1:
+            self.pool = Pool(self.jobs)
+
+            return self.pool.imap(_read_track, records, chunksize=32)
+
+        return imap(_read_track, records)
+
+    def fingerprint_tracks(self, chunk_size=1000):
+        """
+        Fingerprints the tracks that don't have a fingerprint yet, like the
+        ones indexed before fingerprints were enabled or with ``--nometadata``.
+        Tracks are fetched and updated in chunks, and their files are read by
+        a pool of worker processes when more than one job was requested.
+
+        """
+
+        table = m.Track.__table__
+        query = table.update().where(table.c.pk == bindparam('_pk'))
+        pool = Pool(self.jobs) if self.jobs > 1 else None
+        last_pk = 0
+        try:
+            while True:
+                tracks = q(m.Track.pk, m.Track.path).\
+                    filter(m.Track.fingerprint == None).\
+                    filter(m.Track.pk > last_pk).\
+                    order_by(m.Track.pk).limit(chunk_size).all()
+                if not tracks:
+                    break
+
+                last_pk = tracks[-1].pk
+                tracks = [(pk, path.encode('utf-8')) for pk, path in tracks]
+                if pool:
+                    results = pool.imap(fingerprint_track, tracks,
+                                        chunksize=32)
                 else:
-                    if self.is_track():
-                        self.track_count += 1
-                        self.save_track()
+                    results = imap(fingerprint_track, tracks)
+
+                rows = [{'_pk': pk, 'fingerprint': fingerprint}
+                        for pk, fingerprint in results if fingerprint]
+                self.update_rows(query, rows)
+                self.fingerprinted += len(rows)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
 
     def _make_unique(self, model):
         """
-        Retrieves all repeated slugs for a given model and appends the
-        instance's primary key to it.
+        Appends the primary key to every repeated slug of the given model,
+        with a single UPDATE statement. Returns the number of rows changed.
 
         """
 
-        slugs = q(model).group_by(model.slug).\
-            having(func.count(model.slug) > 1)
+        table = model.__table__
+        # Selecting from a derived table lets MySQL update the same table.
+        repeated = select([table.c.slug]).group_by(table.c.slug).\
+            having(func.count(table.c.slug) > 1).alias('repeated')
+        query = table.update().\
+            where(table.c.slug.in_(select([repeated.c.slug]))).\
+            values(slug=table.c.slug + u'-' + cast(table.c.pk, String))
 
-        for row in slugs:
-            slug = row.slug
-            for instance in q(model).filter_by(slug=row.slug):
-                instance.slug += '-%s' % instance.pk
+        return self.session.execute(query).rowcount
 
-        return slugs
-
-    # SELECT pk, slug, COUNT(*) FROM tracks GROUP BY slug HAVING COUNT(*) > 1;
     def make_slugs_unique(self):
-        query = self._make_unique(m.Artist)
-        self.session.add_all(query)
-
-        query = self._make_unique(m.Track)
-        self.session.add_all(query)
+        for model in (m.Artist, m.Album, m.Track):
+            count = self._make_unique(model)
+            if count:
+                log.debug('Made %d %s slugs unique.' % (
+                          count, model.__tablename__))
 
         self.session.commit()
 
@@ -321,23 +1500,154 @@ class Indexer(object):
         log.info('\nRun in %d seconds. Avg %.3fs/track.' % (
                  elapsed_time,
                  (elapsed_time / self.track_count)))
-        log.info('Found %d tracks. Skipped: %d. Indexed: %d.' % (
+        log.info('Found %d tracks. Skipped: %d. Unchanged: %d. Moved: %d. '
+                 'Indexed: %d.' % (
                  self.track_count,
                  self.skipped_tracks,
-                 (self.track_count - self.skipped_tracks)))
+                 self.unchanged_tracks,
+                 self.moved_count,
+                 (self.track_count - self.skipped_tracks -
+                  self.unchanged_tracks - self.moved_count)))
         for extension, count in self.count_by_extension.iteritems():
             if count:
                 log.info('%s: %d tracks' % (extension, count))
 
-    def run(self):
+        if self.header_reader:
+            files_read = (self.track_count - self.unchanged_tracks -
+                          self.moved_count)
+            log.info('Read %.1f KiB per track (header-only). %d tracks '
+                     'needed more than %d bytes.' % (
+                     self.bytes_read / 1024.0 / (files_read or 1),
+                     self.unbounded_count, self.header_reader.limit))
+
+        if self.shard:
+            log.info('Wrote %d tracks to %s.' % (self.shard.count,
+                                                 self.shard.path))
+
+        if self.fingerprinted:
+            log.info('Fingerprinted %d tracks indexed without a '
+                     'fingerprint.' % self.fingerprinted)
+
+        if self.resumed_dirs:
+            log.info('Resumed the last run, skipped %d directories it had '
+                     'indexed.' % self.resumed_dirs)
+
+        if self.pruned_tracks:
+            log.info('Pruned %d tracks, %d albums and %d artists.' % (
+                     self.pruned_tracks, self.pruned_albums,
+                     self.pruned_artists))
+
+        if self.scanned_entries:
+            log.info('Scanned %d directory entries, pruned %d excluded '
+                     'directories and saved %d stat calls.' % (
+                     self.scanned_entries, self.pruned_dirs,
+                     self.saved_stats))
+
+        method = 'bulk insert' if self.bulk else 'ORM'
+        if self.row_count and self.write_time:
+            log.info('Wrote %d rows in %.2f seconds (%d rows/s, %s).' % (
+                     self.row_count, self.write_time,
+                     self.row_count / self.write_time, method))
+        elif self.row_count:
+            # Too fast for the clock to tell.
+            log.info('Wrote %d rows (%s).' % (self.row_count, method))
+
+    def run(self, shards=None):
+        """
+        Indexes the media dirs or, if given a list of shards, the tracks in
+        them.
+
+        """
+
         self.initial_time = time()
 
-        for mobject in self.media_dirs:
-            for mdir in mobject.get_valid_dirs():
-                self.walk(mdir, exclude=mobject.get_excluded_dirs())
+        profiler = self.profiler
+        try:
+            if shards:
+                records = profiler.iterate('read', self.read_shards(shards))
+            else:
+                tracks = profiler.iterate('walk', self.find_tracks())
+                records = profiler.iterate('stat', self.stat_tracks(tracks))
+                records = profiler.iterate('read', self.read_tracks(records))
+
+            for record in records:
+                if profiler.enabled:
+                    memo_stats = get_memo_stats()
+                started = time()
+                self.save_track(record)
+                if self.checkpoint:
+                    self.checkpoint.close(os.path.dirname(record['path']))
+                elapsed = time() - started
+                self.write_time += elapsed
+                profiler.add('save', elapsed)
+                profiler.add_record(record)
+                if profiler.enabled:
+                    # Slugs are made while saving, in this process.
+                    profiler.count_memo(get_memo_deltas(memo_stats))
+                if 'bytes_read' in record:
+                    self.bytes_read += record['bytes_read']
+                    self.unbounded_count += record.get('unbounded', False)
+
+                if self.batch_size and self.pending_tracks >= self.batch_size:
+                    self.commit()
+        finally:
+            # By now every record was consumed, or something went wrong. In
+            # both cases the workers are not needed anymore.
+            if self.pool:
+                self.pool.terminate()
+                self.pool.join()
 
         self.final_time = time()
 
+    def update_profile(self):
+        """Copies the indexer's counters to the profiler."""
+
+        counters = self.profiler.counters
+        counters['files'] = self.track_count
+        counters['unchanged'] = self.unchanged_tracks
+        counters['skipped'] = self.skipped_tracks
+        counters['rows'] = self.row_count
+        counters['scanned_entries'] = self.scanned_entries
+        counters['saved_stats'] = self.saved_stats
+        counters['pruned_tracks'] = self.pruned_tracks
+        counters['moved'] = self.moved_count
+        counters['resumed_dirs'] = self.resumed_dirs
+        counters['fingerprinted'] = self.fingerprinted
+        cache = self.enricher.cache if self.use_lastfm else None
+        if cache:
+            counters['lastfm_cache_hits'] = cache.hits
+            counters['lastfm_cache_misses'] = cache.misses
+
+
+def print_duplicates():
+    """
+    Lists the tracks that share a fingerprint, grouped, along with their
+    title and artist.
+
+    """
+
+    track = m.Track
+    repeated = q(track.fingerprint).filter(track.fingerprint != None).\
+        group_by(track.fingerprint).having(func.count(track.pk) > 1).\
+        subquery()
+    query = q(track.fingerprint, track.path, track.title, m.Artist.name).\
+        outerjoin(m.Artist, track.artist_pk == m.Artist.pk).\
+        filter(track.fingerprint.in_(select([repeated.c.fingerprint]))).\
+        order_by(track.fingerprint, track.path)
+
+    groups = 0
+    duplicates = 0
+    for fingerprint, tracks in groupby(query, itemgetter(0)):
+        tracks = list(tracks)
+        groups += 1
+        duplicates += len(tracks) - 1
+        log.info('%s (%d tracks)' % (fingerprint, len(tracks)))
+        for _, path, title, artist in tracks:
+            log.info(u'  %s [%s - %s]' % (path, artist or u'', title or u''))
+
+    log.info('\nFound %d groups of duplicates, %d tracks could be '
+             'removed.' % (groups, duplicates))
+
 
 def main():
     arguments = docopt(__doc__)
@@ -352,12 +1662,88 @@ def main():
     if arguments['--verbose-sql']:
         app.config['SQLALCHEMY_ECHO'] = True
 
+    if arguments['duplicates']:
+        print_duplicates()
+
+        return None
+
+    try:
+        jobs = int(arguments['--jobs'])
+    except ValueError:
+        jobs = 0
+
+    if jobs < 1:
+        sys.stderr.write('ERROR: --jobs must be a positive integer.\n')
+        sys.exit(1)
+
+    try:
+        batch_size = int(arguments['--batch-size'])
+    except ValueError:
+        batch_size = -1
+
+    if batch_size < 0:
+        sys.stderr.write('ERROR: --batch-size must be a positive integer, or '
+                         '0.\n')
+        sys.exit(1)
+
+    try:
+        readahead = int(arguments['--readahead'])
+        read_limit = int(arguments['--read-limit'])
+    except ValueError:
+        readahead = read_limit = 0
+
+    if readahead <= 0 or read_limit <= 0:
+        sys.stderr.write('ERROR: --readahead and --read-limit must be '
+                         'positive integers.\n')
+        sys.exit(1)
+
+    part = None
+    if arguments['--part']:
+        try:
+            part = tuple(int(n) for n in arguments['--part'].split('/'))
+            k, n = part
+        except ValueError:
+            k = n = 0
+
+        if not 1 <= k <= n:
+            sys.stderr.write('ERROR: --part must be k/n, with k between 1 and '
+                             'n.\n')
+            sys.exit(1)
+
+    shard_path = arguments['--shard']
+    if shard_path and (arguments['--lastfm'] or arguments['--reindex'] or
+                       arguments['--prune'] or arguments['--watch']):
+        sys.stderr.write('ERROR: --shard can\'t be used with --lastfm, '
+                         '--reindex, --prune or --watch, they only make sense '
+                         'when merging.\n')
+        sys.exit(1)
+
+    resume = arguments['--resume']
+    if resume and arguments['--reindex']:
+        sys.stderr.write('ERROR: --resume can\'t be used with --reindex, it '
+                         'would drop what the last run indexed.\n')
+        sys.exit(1)
+
     kwargs = {
         'use_lastfm': arguments['--lastfm'],
         'no_metadata': arguments['--nometadata'],
         'reindex': arguments['--reindex'],
+        'jobs': jobs,
+        'batch_size': batch_size,
+        'partial_hash': arguments['--partial-hash'],
+        'fingerprint': arguments['--fingerprint'],
+        'part': part,
+        'use_bulk': not arguments['--no-bulk'],
     }
 
+    if arguments['--header-only']:
+        kwargs['header_reader'] = HeaderReader(readahead=readahead,
+                                               limit=read_limit)
+
+    profile_json = arguments['--profile-json']
+    profiler = Profiler(enabled=arguments['--profile'] or bool(profile_json))
+    kwargs['profiler'] = profiler
+
     if kwargs['no_metadata']:
         kwargs['use_lastfm'] = False
 
@@ -366,21 +1752,82 @@ def main():
                          '--lastfm flag.\n')
         sys.exit(1)
 
-    # Generate database
-    db.create_all()
+    if shard_path:
+        kwargs['shard'] = ShardWriter(shard_path, part=part,
+                                      no_metadata=kwargs['no_metadata'])
+    else:
+        # Generate database
+        db.create_all()
+
+    # Only runs that walk the media dirs into the database can be resumed.
+    if not shard_path and not arguments['merge']:
+        checkpoint = Checkpoint(get_checkpoint_path(
+            app.config['SQLALCHEMY_DATABASE_URI'], part))
+        if resume and not checkpoint.load():
+            log.warn('There is no run to resume, indexing everything.')
+            resume = False
+        kwargs['checkpoint'] = checkpoint
 
     lola = Indexer(app.config, **kwargs)
-    lola.run()
+    try:
+        lola.run(shards=arguments['<shard>'])
+    except ShardError, e:
+        sys.stderr.write('ERROR: %s\n' % e)
+        sys.exit(1)
+
+    if lola.shard:
+        lola.close_shard()
+    else:
+        # Tracks are written down to disk in batches, while indexing. Write
+        # down whatever is left from the last one.
+        lola.commit()
+
+        # The tracks in the directories skipped when resuming were not
+        # checked off, pruning would delete them.
+        if arguments['--prune'] and resume:
+            log.warn('Not pruning, the run was resumed.')
+        elif arguments['--prune']:
+            with profiler.phase('prune'):
+                lola.prune()
+                lola.commit()
+
+        if kwargs['fingerprint']:
+            with profiler.phase('fingerprint'):
+                lola.fingerprint_tracks()
+
+        # Finished, there is nothing to resume.
+        if lola.checkpoint:
+            lola.checkpoint.remove()
+            lola.checkpoint = None
 
     lola.print_stats()
 
-    # Petit performance hack: Every track will be added to the session but they
-    # will be written down to disk only once, at the end.
-    log.debug('Writing to database...')
-    lola.session.commit()
+    if not lola.shard:
+        log.debug('Checking for duplicated tracks...')
+        with profiler.phase('slugs'):
+            lola.make_slugs_unique()
+
+        with profiler.phase('lastfm'):
+            lola.enrich()
+
+    if profiler.enabled:
+        profiler.finish()
+        lola.update_profile()
+        profiler.print_report()
+        if profile_json:
+            profiler.write_json(profile_json)
 
-    log.debug('Checking for duplicated tracks...')
-    lola.make_slugs_unique()
+    if arguments['--watch']:
+        try:
+            watcher = Watcher(lola)
+        except RuntimeError, e:
+            sys.stderr.write('ERROR: %s\n' % e)
+            sys.exit(1)
+
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            watcher.apply_changes()
 
 
 if __name__ == '__main__':
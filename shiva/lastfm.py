@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+Retrieves artist images, album covers and release years from the Last.FM API.
+
+"""
+from datetime import datetime
+from Queue import Queue
+from time import sleep, time
+from urlparse import urlparse
+import httplib
+import json
+import sqlite3
+import threading
+
+from shiva.exceptions import LastFMError
+from shiva.utils import get_logger, normalize_name
+
+log = get_logger()
+
+# Put in the results queue by the workers when a lookup fails.
+FAILED = object()
+# Returned by the client when Last.FM doesn't know about something.
+NOT_FOUND = object()
+
+
+class RateLimiter(object):
+    """
+    Spaces calls so no more than ``rate`` of them start per second, no matter
+    how many threads share the limiter.
+
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return None
+
+        with self.lock:
+            now = time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+
+        if delay > 0:
+            sleep(delay)
+
+
+class LastResponseCache(object):
+    """
+    pylast cache backend that remembers the last response each thread got.
+    pylast requests ``album.getInfo`` again for every getter of an album, and
+    ``artist.getInfo`` for every image size. With this, all of them come from
+    a single request.
+
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def has_key(self, key):
+        return getattr(self.local, 'key', None) == key
+
+    def get_xml(self, key):
+        return self.local.xml
+
+    def set_xml(self, key, xml):
+        self.local.key = key
+        self.local.xml = xml
+
+
+class TimeoutHTTPConnection(httplib.HTTPConnection):
+    """
+    The connection pylast makes its requests with. pylast doesn't take a
+    timeout, so it's set here from the client making the request in the
+    current thread, instead of changing the default for every socket in the
+    process.
+
+    """
+
+    local = threading.local()
+
+    def __init__(self, *args, **kwargs):
+        timeout = getattr(self.local, 'timeout', None)
+        if timeout:
+            kwargs.setdefault('timeout', timeout)
+
+        httplib.HTTPConnection.__init__(self, *args, **kwargs)
+
+
+class LastFMClient(object):
+    """
+    Thin layer on top of pylast. Every request waits for the rate limiter,
+    and is retried, with an increasing delay, when it fails or Last.FM reports
+    a temporary error.
+
+    """
+
+    # Codes of errors worth retrying: operation failed, service offline,
+    # temporarily unavailable and rate limit exceeded.
+    TEMPORARY_ERRORS = (8, 11, 16, 29)
+
+    def __init__(self, api_key, api_url=None, timeout=10, retries=3,
+                 rate_limiter=None, backoff=0.5):
+        import pylast
+
+        # The class pylast instantiates for every request.
+        pylast.HTTPConnection = TimeoutHTTPConnection
+        self.pylast = pylast
+        self.network = pylast.LastFMNetwork(api_key=api_key)
+        if api_url:
+            url = urlparse(api_url)
+            self.network.ws_server = (url.netloc, url.path or '/')
+        self.network.cache_backend = LastResponseCache()
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limiter = rate_limiter or RateLimiter()
+
+    def call(self, getter):
+        """
+        Calls a function that makes a request through pylast, and returns its
+        result. Returns ``NOT_FOUND`` if Last.FM answered with a permanent
+        error, like an unknown artist, and raises ``LastFMError`` if all the
+        attempts failed.
+
+        """
+
+        name = getter.__name__
+        TimeoutHTTPConnection.local.timeout = self.timeout
+        for attempt in xrange(self.retries + 1):
+            if attempt:
+                sleep(self.backoff * 2 ** attempt)
+
+            self.rate_limiter.wait()
+            try:
+                return getter()
+            except self.pylast.WSError, e:
+                log.debug('[ Last.FM ] %s: %s (%s)' % (name, e, e.get_id()))
+                if int(e.get_id()) not in self.TEMPORARY_ERRORS:
+                    return NOT_FOUND
+            except (self.pylast.NetworkError,
+                    self.pylast.MalformedResponseError, IndexError), e:
+                # pylast fails with IndexError on responses that are not from
+                # Last.FM, like error pages.
+                log.debug('[ Last.FM ] %s: %s' % (name, e))
+
+        raise LastFMError('Giving up on %s after %d attempts' % (
+                          name, self.retries + 1))
+
+    def get_image(self, item, size):
+        """
+        Returns the URL of the artist's or album's image of the given size, or
+        of the largest smaller one if that size is not available. The images
+        must have been requested already.
+
+        """
+
+        for _size in xrange(size, -1, -1):
+            try:
+                image = item.get_cover_image(_size)
+            except IndexError:
+                # Fewer images than sizes.
+                continue
+
+            if image:
+                return image
+
+        return None
+
+    def get_artist(self, name):
+        """Returns a dict with the ``image`` of the artist."""
+
+        artist = self.network.get_artist(name)
+
+        def get_artist_info():
+            # Makes the request, the images are taken from its response.
+            artist.get_mbid()
+
+            return self.get_image(artist, self.pylast.COVER_MEGA)
+
+        image = self.call(get_artist_info)
+        if image is NOT_FOUND:
+            return None
+
+        return {'image': image}
+
+    def get_album(self, artist_name, name):
+        """Returns a dict with the album's ``cover`` and release ``year``."""
+
+        album = self.network.get_album(artist_name, name)
+
+        def get_album_info():
+            # Makes the request, the images are taken from its response.
+            release_date = album.get_release_date()
+
+            return (release_date,
+                    self.get_image(album, self.pylast.COVER_EXTRA_LARGE))
+
+        info = self.call(get_album_info)
+        if info is NOT_FOUND:
+            return None
+
+        release_date, cover = info
+        year = None
+        if release_date:
+            try:
+                year = datetime.strptime(release_date, '%d %b %Y, %H:%M').year
+            except ValueError:
+                pass
+
+        return {
+            'cover': cover,
+            'year': year,
+        }
+
+
+class LastFMCache(object):
+    """
+    Persistent cache for Last.FM lookups, stored in a SQLite file and keyed by
+    the lookup and the normalized names it receives. Lookups that found
+    nothing are cached too, but for a shorter time, so they are eventually
+    retried.
+
+    """
+
+    def __init__(self, path, ttl=60 * 60 * 24 * 30,
+                 negative_ttl=60 * 60 * 24 * 7):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS lookups ('
+                          'key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    def get_key(self, method, args):
+        return u'%s:%s' % (method, u'\x00'.join(normalize_name(arg)
+                                                for arg in args))
+
+    def get(self, method, args):
+        """
+        Returns a ``(found, value)`` tuple. ``value`` may be None, meaning
+        that Last.FM didn't know about it.
+
+        """
+
+        row = self.conn.execute('SELECT value FROM lookups WHERE key = ? AND '
+                                'expires > ?', (self.get_key(method, args),
+                                                time())).fetchone()
+        if row is None:
+            self.misses += 1
+
+            return False, None
+
+        self.hits += 1
+
+        return True, json.loads(row[0])
+
+    def set(self, method, args, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        self.conn.execute('INSERT OR REPLACE INTO lookups VALUES (?, ?, ?)',
+                          (self.get_key(method, args), json.dumps(value),
+                           time() + ttl))
+
+    def commit(self):
+        self.conn.commit()
+
+
+class Enricher(object):
+    """
+    Fetches Last.FM information for many artists and albums at once, using a
+    pool of threads. The results are handed back to the calling thread, so the
+    database (and the cache, if given) is only touched from there.
+
+    """
+
+    def __init__(self, client, workers=4, cache=None):
+        self.client = client
+        self.workers = workers
+        self.cache = cache
+
+    def fetch(self, jobs):
+        """
+        Receives a list of ``(key, method, args)`` tuples, calls
+        ``method(*args)`` on the client for each of them and yields
+        ``(key, result)`` tuples as soon as they are available. Failed
+        lookups are logged and left out.
+
+        """
+
+        if self.cache:
+            _jobs = []
+            for key, method, args in jobs:
+                found, result = self.cache.get(method, args)
+                if found:
+                    yield key, result
+                else:
+                    _jobs.append((key, method, args))
+
+            log.debug('[ Last.FM ] %d lookups cached, %d to go.' % (
+                      len(jobs) - len(_jobs), len(_jobs)))
+            jobs = _jobs
+
+        if not jobs:
+            return
+
+        pending = Queue()
+        results = Queue()
+        workers = min(self.workers, len(jobs))
+        for job in jobs:
+            pending.put(job)
+
+        # One stop signal for each worker.
+        for i in xrange(workers):
+            pending.put(None)
+
+        def work():
+            for key, method, args in iter(pending.get, None):
+                try:
+                    result = getattr(self.client, method)(*args)
+                except Exception, e:
+                    log.warn('[ Last.FM ] %s%s: %s' % (method, args, e))
+                    result = FAILED
+                results.put((key, method, args, result))
+
+        for i in xrange(workers):
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for i in xrange(len(jobs)):
+                # With a timeout, so the main thread still notices Ctrl-C.
+                key, method, args, result = results.get(timeout=1e6)
+                if result is FAILED:
+                    continue
+
+                if self.cache:
+                    self.cache.set(method, args, result)
+
+                yield key, result
+        finally:
+            if self.cache:
+                self.cache.commit()
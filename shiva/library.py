@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+The version of the music library: a number, kept in a file, that goes up
+every time the database is changed, be it by the indexer or through the API.
+Responses are tagged with it, so the API can tell clients that what they got
+before is still current without querying the database.
+
+"""
+from contextlib import contextmanager
+from hashlib import md5
+import os
+import threading
+from time import time
+
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session
+
+from shiva.exceptions import LibraryVersionFileError
+from shiva.utils import get_data_path
+
+
+def get_library_version_path(config):
+    """
+    Returns the path of the file that holds the version of the library kept
+    in the configured database. ``LIBRARY_VERSION_FILE`` can point somewhere
+    else, e.g. to a file shared by the hosts that index into a common
+    database and the ones that serve it.
+
+    By default a SQLite database keeps it next to its own file, where the
+    indexer and the server find it even if they run as different users.
+    Other databases have no such place, so the setting is required.
+
+    """
+
+    path = config.get('LIBRARY_VERSION_FILE')
+    if path:
+        return path
+
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    url = make_url(uri)
+    if url.drivername.split('+')[0] != 'sqlite':
+        raise LibraryVersionFileError(url.drivername)
+
+    if url.database and url.database != ':memory:':
+        return '%s.version' % url.database
+
+    # Nobody else can open an in-memory database.
+    key = md5(uri).hexdigest()[:16]
+
+    return get_data_path('library-%s.version' % key)
+
+
+def get_library_version(path):
+    """
+    Returns the version of the library and the time, as a timestamp, when it
+    last changed. A library that never changed is at version 0, with no time.
+
+    """
+
+    try:
+        with open(path) as version_file:
+            version, changed = version_file.read().split()
+
+        return int(version), float(changed)
+    except (IOError, ValueError):
+        return 0, None
+
+
+@contextmanager
+def locked(path):
+    """
+    Context manager that holds an exclusive lock on the given file, where the
+    platform supports it.
+
+    """
+
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    with open(path, 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+        # Released when the file is closed.
+        yield
+
+
+def bump_library_version(path):
+    """Increments the version of the library, and returns the new one."""
+
+    with locked('%s.lock' % path):
+        version = get_library_version(path)[0] + 1
+        # Written aside and renamed, so readers never see half a file.
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as version_file:
+            version_file.write('%d %f\n' % (version, time()))
+        os.rename(tmp_path, path)
+
+    return version
+
+
+def track_library_changes(engine, path, ignore=None):
+    """
+    Bumps the version of the library every time a session commits changes
+    made through the given engine. Every INSERT, UPDATE or DELETE that hits a
+    row counts, whether it comes from the ORM or is a bulk statement, unless
+    the ``ignore`` callable, if given, returns True when it's executed.
+
+    Sessions are not shared between threads, and neither are the changes
+    waiting for their commit.
+
+    """
+
+    pending = threading.local()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        if context is None or cursor.rowcount == 0:
+            return None
+
+        if ignore is not None and ignore():
+            return None
+
+        if context.isinsert or context.isupdate or context.isdelete:
+            pending.changes = True
+
+    @event.listens_for(Session, 'after_commit')
+    def after_commit(session):
+        if getattr(pending, 'changes', False):
+            pending.changes = False
+            bump_library_version(path)
+
+    @event.listens_for(Session, 'after_rollback')
+    def after_rollback(session):
+        pending.changes = False
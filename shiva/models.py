@@ -31,6 +31,8 @@ class Artist(db.Model):
     """
 
     __tablename__ = 'artists'
+    # The order of the listings, see ``shiva.resources.paginate``.
+    __table_args__ = (db.Index('ix_artists_order', 'name', 'pk'),)
 
     pk = db.Column(db.Integer, primary_key=True)
     # TODO: Update the files' Metadata when changing this info.
@@ -73,6 +75,8 @@ class Album(db.Model):
     """
 
     __tablename__ = 'albums'
+    # The order of the listings, see ``shiva.resources.paginate``.
+    __table_args__ = (db.Index('ix_albums_order', 'year', 'name', 'pk'),)
 
     pk = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), nullable=False)
@@ -110,6 +114,8 @@ class Track(db.Model):
     """Track model."""
 
     __tablename__ = 'tracks'
+    # The order of the listings, see ``shiva.resources.paginate``.
+    __table_args__ = (db.Index('ix_tracks_order', 'album_pk', 'number', 'pk'),)
 
     pk = db.Column(db.Integer, primary_key=True)
     path = db.Column(db.Unicode(256), unique=True, nullable=False)
@@ -123,6 +129,16 @@ class Track(db.Model):
     # TODO number should probably be renamed to track or track_number
     number = db.Column(db.Integer)
     date_added = db.Column(db.Date(), nullable=False)
+    # Used by the indexer to find out which files changed since the last run.
+    mtime = db.Column(db.Integer)
+    inode = db.Column(db.BigInteger)
+    device = db.Column(db.BigInteger)
+    last_indexed = db.Column(db.DateTime())
+    # Hash of the beginning and end of the file, see ``get_partial_hash``.
+    partial_hash = db.Column(db.String(32))
+    # Hash of samples of the audio data, see ``shiva.fingerprint``. Tracks
+    # with the same one are most likely duplicates.
+    fingerprint = db.Column(db.String(32), index=True)
 
     lyrics = db.relationship('LyricsCache', backref='track', uselist=False)
 
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Collects timings and counters of an indexer run, to find out where the time
+goes.
+
+"""
+from array import array
+from collections import defaultdict
+from time import time
+import json
+import threading
+
+from shiva.utils import get_logger
+
+log = get_logger()
+
+
+class NoPhase(object):
+    """Context manager that does nothing, used when profiling is disabled."""
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return None
+
+
+def get_read_counters():
+    """
+    Returns the number of bytes this process has read so far, and the number
+    of read system calls it took, or None if the OS doesn't tell.
+
+    """
+
+    try:
+        with open('/proc/self/io') as io:
+            counters = dict(line.split(':', 1) for line in io)
+
+        return int(counters['rchar']), int(counters['syscr'])
+    except (IOError, ValueError, KeyError):
+        return None
+
+
+class Phase(object):
+    """Context manager that adds the time spent in it to a phase."""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.started = time()
+        self.profiler.get_stack().append(0)
+
+    def __exit__(self, *args):
+        elapsed = time() - self.started
+        stack = self.profiler.get_stack()
+        # Time spent in nested phases is only counted for those.
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+
+        self.profiler.add(self.name, elapsed - nested)
+
+
+class Profiler(object):
+    """
+    Accumulates the wall time of every phase of the indexer, and counters
+    like the number of files read or rows written. When disabled every method
+    is a no-op, so the indexer can call them unconditionally.
+
+    Phases may nest, each one only accounts for the time not spent in its
+    nested phases. Phases running in different threads (like walking the
+    media dirs while the worker processes read the files) overlap, so their
+    times may add up to more than the total.
+
+    """
+
+    # In the order they happen.
+    PHASES = ('walk', 'stat', 'read', 'save', 'commit', 'prune', 'fingerprint',
+              'slugs', 'lastfm')
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started = time()
+        self.finished = None
+        self.times = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.parse_times = array('d')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def get_stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+
+        return self.local.stack
+
+    def phase(self, name):
+        """Returns a context manager that times the block it wraps."""
+
+        if not self.enabled:
+            return NoPhase()
+
+        return Phase(self, name)
+
+    def iterate(self, name, iterable):
+        """Times every step of the given iterable as part of the phase."""
+
+        if not self.enabled:
+            return iterable
+
+        return self._iterate(name, iter(iterable))
+
+    def _iterate(self, name, iterator):
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+
+            yield item
+
+    def add(self, name, elapsed):
+        if not self.enabled:
+            return None
+
+        with self.lock:
+            self.times[name] += elapsed
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return None
+
+        with self.lock:
+            self.counters[name] += value
+
+    def add_record(self, record):
+        """Collects the timings ``read_track`` stored in the record."""
+
+        if not self.enabled:
+            return None
+
+        timings = record.get('timings')
+        if not timings:
+            return None
+
+        self.count('files_read')
+        if 'parse' in timings:
+            self.parse_times.append(timings['parse'])
+        if 'year' in timings:
+            self.add('year_parsing', timings['year'])
+        if timings.get('bytes_read') is not None:
+            self.count('bytes_read', timings['bytes_read'])
+            self.count('read_calls', timings['read_calls'])
+        if timings.get('memo'):
+            self.count_memo(timings['memo'])
+
+    def count_memo(self, deltas):
+        """
+        Counts the hits and misses of the memoized functions, as returned by
+        ``get_memo_deltas``.
+
+        """
+
+        for name, (hits, misses) in deltas.iteritems():
+            self.count('%s_cache_hits' % name, hits)
+            self.count('%s_cache_misses' % name, misses)
+
+    def finish(self):
+        self.finished = time()
+
+    def get_percentile(self, values, percentile):
+        if not values:
+            return None
+
+        return values[int(round(percentile / 100.0 * (len(values) - 1)))]
+
+    def get_rate(self, counter, phase):
+        elapsed = self.times.get(phase)
+        if not elapsed or counter not in self.counters:
+            return None
+
+        return self.counters[counter] / elapsed
+
+    def get_hit_rates(self):
+        rates = {}
+        for counter, hits in self.counters.iteritems():
+            if counter.endswith('_cache_hits'):
+                name = counter[:-len('_cache_hits')]
+                calls = hits + self.counters.get('%s_cache_misses' % name, 0)
+                rates[name] = float(hits) / calls if calls else None
+
+        return rates
+
+    def get_report(self):
+        """Returns every measure in a dict, ready to be dumped as JSON."""
+
+        total = (self.finished or time()) - self.started
+        parse_times = sorted(self.parse_times)
+        phases = [phase for phase in self.PHASES if phase in self.times]
+        phases.extend(sorted(set(self.times) - set(phases)))
+        write_time = self.times.get('save', 0) + self.times.get('commit', 0)
+
+        return {
+            'total': total,
+            'phases': dict((phase, self.times[phase]) for phase in phases),
+            'counters': dict(self.counters),
+            'rates': {
+                'files_per_second': self.get_rate('files', 'walk'),
+                'files_read_per_second': self.get_rate('files_read', 'read'),
+                'bytes_read_per_second': self.get_rate('bytes_read', 'read'),
+                'rows_per_second': (self.counters.get('rows', 0) /
+                                    write_time if write_time else None),
+            },
+            'cache_hit_rates': self.get_hit_rates(),
+            'parse_latency': {
+                'p50': self.get_percentile(parse_times, 50),
+                'p99': self.get_percentile(parse_times, 99),
+                'max': parse_times[-1] if parse_times else None,
+            },
+        }
+
+    def print_report(self):
+        report = self.get_report()
+
+        log.info('\nProfile (%.2f seconds):' % report['total'])
+        for phase in self.PHASES:
+            if phase in report['phases']:
+                log.info('  %-12s %8.2fs' % (phase, report['phases'][phase]))
+        for phase, elapsed in sorted(report['phases'].iteritems()):
+            if phase not in self.PHASES:
+                log.info('  %-12s %8.2fs' % (phase, elapsed))
+
+        for name, value in sorted(report['counters'].iteritems()):
+            log.info('  %-24s %d' % (name, value))
+
+        for name, value in sorted(report['rates'].iteritems()):
+            if value is not None:
+                log.info('  %-24s %.1f' % (name, value))
+
+        for name, rate in sorted(report['cache_hit_rates'].iteritems()):
+            if rate is not None:
+                log.info('  %-24s %.1f%%' % ('%s cache hit rate' % name,
+                                             rate * 100))
+
+        latency = report['parse_latency']
+        if latency['p50'] is not None:
+            log.info('  parse latency            p50 %.2fms, p99 %.2fms, '
+                     'max %.2fms' % (latency['p50'] * 1000,
+                                     latency['p99'] * 1000,
+                                     latency['max'] * 1000))
+
+    def write_json(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.get_report(), output, indent=2, sort_keys=True)
+
+        log.info('Profile written to %s' % path)
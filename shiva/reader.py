@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Header-only reading of audio files. Tag parsers issue lots of small reads and
+seeks, and on network filesystems each of them may be a round trip. Here they
+are served from a read-ahead buffer instead, and the amount of data read from
+each file is bounded.
+
+"""
+from contextlib import contextmanager
+import errno
+import io
+import os
+
+import mutagen
+import mutagen.apev2
+import mutagen.asf
+import mutagen.flac
+import mutagen.id3
+import mutagen.m4a
+import mutagen.mp4
+import mutagen.ogg
+
+from shiva.exceptions import ReadLimitExceeded
+
+# Modules that open the files they parse by name.
+MUTAGEN_MODULES = (mutagen, mutagen.apev2, mutagen.asf, mutagen.flac,
+                   mutagen.id3, mutagen.m4a, mutagen.mp4, mutagen.ogg)
+
+# Values of the posix_fadvise() advices, as defined by Linux.
+POSIX_FADV_RANDOM = 1
+POSIX_FADV_DONTNEED = 4
+
+_fadvise = None
+
+
+def fadvise(fd, advice):
+    """
+    Gives the kernel a hint about how a file will be read, if the platform
+    supports ``posix_fadvise()``. Returns whether the hint was given.
+
+    """
+
+    global _fadvise
+
+    if _fadvise is None:
+        _fadvise = False
+        try:
+            import ctypes
+            import ctypes.util
+
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _fadvise = getattr(libc, 'posix_fadvise64', None) or \
+                libc.posix_fadvise
+            _fadvise.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                                 ctypes.c_int)
+        except (ImportError, OSError, AttributeError, TypeError):
+            _fadvise = False
+
+    if not _fadvise:
+        return False
+
+    return _fadvise(fd, 0, 0, advice) == 0
+
+
+class BoundedFile(object):
+    """
+    Read-only file object that reads from disk in blocks of at least
+    ``readahead`` bytes, and raises ``ReadLimitExceeded`` before reading more
+    than ``limit`` bytes in total. The kernel is told not to read ahead on its
+    own, and to drop the pages read once the file is closed.
+
+    """
+
+    def __init__(self, reader, path):
+        self.reader = reader
+        self.name = path
+        self.file = io.open(path, 'rb', buffering=0)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.position = 0
+        self.buffer = ''
+        self.buffer_offset = 0
+        self.bytes_read = 0
+
+        fadvise(self.file.fileno(), POSIX_FADV_RANDOM)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+
+        if offset < 0:
+            raise IOError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        self.position = offset
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+
+        end = min(self.position + size, self.size)
+        if end <= self.position:
+            return ''
+
+        buffer_end = self.buffer_offset + len(self.buffer)
+        if not (self.buffer_offset <= self.position and end <= buffer_end):
+            self.fill(end)
+
+        start = self.position - self.buffer_offset
+        data = self.buffer[start:start + end - self.position]
+        self.position = end
+
+        return data
+
+    def fill(self, end):
+        """
+        Fills the buffer from the current position up to, at least, the
+        ``end`` offset. Whatever is already buffered is not read again.
+
+        """
+
+        buffer_end = self.buffer_offset + len(self.buffer)
+        if self.buffer_offset <= self.position <= buffer_end:
+            start = buffer_end
+            kept = self.buffer[self.position - self.buffer_offset:]
+        else:
+            start = self.position
+            kept = ''
+
+        size = end - start
+        budget = self.reader.limit - self.bytes_read
+        if size > budget:
+            raise ReadLimitExceeded(self.reader, self.name)
+
+        size = max(size, min(self.reader.readahead, budget))
+        self.file.seek(start)
+        data = self.file.read(size)
+        self.buffer = kept + data
+        self.buffer_offset = self.position
+        self.bytes_read += len(data)
+        self.reader.bytes_read += len(data)
+
+    def close(self):
+        if self.file.closed:
+            return None
+
+        fadvise(self.file.fileno(), POSIX_FADV_DONTNEED)
+        self.file.close()
+
+
+class HeaderReader(object):
+    """
+    Makes mutagen open every file it reads through a ``BoundedFile``, and
+    keeps count of the bytes read. Files opened for writing are not affected.
+
+    """
+
+    # The reader mutagen is using, if any.
+    installed = None
+
+    def __init__(self, readahead=16 * 1024, limit=1024 * 1024):
+        self.readahead = readahead
+        self.limit = limit
+        self.enabled = True
+        self.bytes_read = 0
+        self.unbounded_reads = 0
+
+    def open(self, path, mode='r', *args, **kwargs):
+        if self.enabled and mode == 'rb':
+            return BoundedFile(self, path)
+
+        return open(path, mode, *args, **kwargs)
+
+    def install(self):
+        for module in MUTAGEN_MODULES:
+            module.open = self.open
+
+        HeaderReader.installed = self
+
+    @contextmanager
+    def unbounded(self):
+        """
+        Context manager that reads files as usual, for the ones that exceed
+        the limit.
+
+        """
+
+        self.enabled = False
+        self.unbounded_reads += 1
+        try:
+            yield
+        finally:
+            self.enabled = True
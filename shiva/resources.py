@@ -1,21 +1,29 @@
 # -*- coding: utf-8 -*-
+import base64
 from datetime import datetime
+import json
+import urllib
 import urllib2
 import traceback
 
 from flask import request, current_app as app, g
 from flask.ext.restful import abort, fields, marshal
 import requests
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Query
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 
 from shiva import get_version, get_contributors
 from shiva.converter import get_converter
 from shiva.exceptions import InvalidMimeTypeError
 from shiva.fields import (Boolean, ForeignKeyField, InstanceURI,
                           ManyToManyField, TrackFiles)
-from shiva.http import Resource, JSONResponse
+from shiva.http import Resource, JSONArrayResponse, JSONResponse
+from shiva.library import bump_library_version, get_library_version_path
 from shiva.lyrics import get_lyrics
 from shiva.mocks import ShowModel
-from shiva.models import Artist, Album, Track, LyricsCache
+from shiva.models import Artist, Album, Track, LyricsCache, artists
 from shiva.utils import get_logger
 
 log = get_logger()
@@ -29,10 +37,91 @@ def full_tree():
     return (arg and arg not in ('false', '0'))
 
 
-def paginate(queryset):
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def decode_cursor(cursor, length):
     """
-    Function that receives a queryset and paginates it based on the GET
-    parameters.
+    Returns the values of the sort keys held by a cursor. Aborts with a 400
+    if the cursor is not valid.
+
+    """
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, ValueError, UnicodeError):
+        values = None
+
+    if not isinstance(values, list) or len(values) != length:
+        abort(400, message='Invalid cursor')
+
+    return values
+
+
+# Databases that sort NULLs after every value in ascending order. The rest,
+# like SQLite and MySQL, sort them first.
+NULLS_LAST_DIALECTS = ('postgresql', 'oracle')
+
+
+def after(keys, values, nulls_first=True):
+    """
+    Returns the condition matched by the rows that come after the given
+    values of the sort keys, all in ascending order, with NULLs either first
+    or last. It's nested and, when NULLs are first, bounded below by the first
+    key, so the database can seek to the position instead of scanning.
+
+    The last key must not be NULL.
+
+    """
+
+    condition = None
+    for key, value in reversed(zip(keys, values)):
+        if value is None:
+            # Nothing comes after NULLs when they are last.
+            greater = key.isnot(None) if nulls_first else None
+            equal = key.is_(None)
+        else:
+            greater = key > value
+            if not nulls_first:
+                greater = or_(greater, key.is_(None))
+            equal = key == value
+
+        if condition is None:
+            condition = greater
+        elif greater is None:
+            condition = and_(equal, condition)
+        else:
+            condition = or_(greater, and_(equal, condition))
+            if value is not None and nulls_first:
+                condition = and_(key >= value, condition)
+
+    return condition
+
+
+def get_next_page_uri(instance, keys):
+    """
+    Returns the URI of the page that follows the given instance, with the
+    same parameters as the current request but a cursor instead of a page
+    number.
+
+    """
+
+    args = request.args.to_dict()
+    args.pop('page', None)
+    args['cursor'] = encode_cursor([getattr(instance, key.key)
+                                    for key in keys])
+    query = urllib.urlencode(sorted((key, value.encode('utf-8'))
+                                    for key, value in args.iteritems()))
+
+    return ''.join((app.config.get('SERVER_URI') or '', request.path, '?',
+                    query))
+
+
+def get_page():
+    """
+    Returns the size, the number and the cursor of the page requested in the
+    GET parameters, or None if no page was requested.
 
     """
 
@@ -46,15 +135,138 @@ def paginate(queryset):
     except ValueError:
         page_number = 0
 
-    if not page_size or not page_number:
+    cursor = request.args.get('cursor')
+
+    if page_size < 1 or (page_number < 1 and not cursor):
+        return None
+
+    return page_size, page_number, cursor
+
+
+def paginate(queryset, keys):
+    """
+    Function that receives a queryset, orders it by the given columns and
+    paginates it based on the GET parameters.
+
+    Pages are requested either by number, with ``page``, or by cursor, with
+    ``cursor``. Cursors hold the values of the sort keys of the last element
+    of the previous page, so getting a page costs the same no matter how deep
+    into the results it is. When there are more results the URI of the next
+    page is added to the response as a ``Link`` header.
+
+    Returns the ordered queryset if no page was requested, and a list of the
+    elements of the page otherwise.
+
+    """
+
+    queryset = queryset.order_by(*keys)
+
+    page = get_page()
+    if page is None:
         return queryset
 
-    total = queryset.count()
+    page_size, page_number, cursor = page
+    if cursor:
+        values = decode_cursor(cursor, len(keys))
+        nulls_first = g.db.engine.dialect.name not in NULLS_LAST_DIALECTS
+        queryset = queryset.filter(after(keys, values, nulls_first))
+    else:
+        queryset = queryset.offset(page_size * (page_number - 1))
 
-    limit = page_size
-    offset = page_size * (page_number - 1)
+    # One more than needed, to know if there is a next page.
+    page = queryset.limit(page_size + 1).all()
+    if len(page) > page_size:
+        page = page[:page_size]
+        g.next_page = get_next_page_uri(page[-1], keys)
 
-    return queryset.limit(limit).offset(offset)
+    return page
+
+
+def batches(elements, size=500):
+    """
+    Iterates over the elements in lists of up to ``size`` of them. Querysets
+    are read from the database as they go, ``size`` rows at a time, instead
+    of all at once.
+
+    """
+
+    if isinstance(elements, Query):
+        elements = elements.yield_per(size)
+
+    batch = []
+    for element in elements:
+        batch.append(element)
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def get_listing(elements):
+    """
+    Returns the response for a listing of marshalled elements. A page is
+    returned as a list, but a whole collection is streamed as it's read from
+    the database, so the response starts right away and memory doesn't grow
+    with the size of the collection.
+
+    """
+
+    if get_page() is not None:
+        return list(elements)
+
+    return JSONArrayResponse(elements)
+
+
+def prefetch(model, pks, chunk_size=500):
+    """
+    Loads the instances of ``model`` with the given primary keys, in chunks,
+    and returns them in a dict by primary key. Instances already in the
+    session are not loaded again. As long as the dict is around they stay in
+    the session's identity map, where ``ForeignKeyField`` finds them without
+    querying the database once per serialized object.
+
+    """
+
+    identity_map = g.db.session.identity_map
+    instances = {}
+    missing = []
+    for pk in set(pk for pk in pks if pk):
+        instance = identity_map.get(identity_key(model, pk))
+        if instance is None:
+            missing.append(pk)
+        else:
+            instances[pk] = instance
+
+    for i in xrange(0, len(missing), chunk_size):
+        chunk = missing[i:i + chunk_size]
+        for instance in model.query.filter(model.pk.in_(chunk)):
+            instances[instance.pk] = instance
+
+    return instances
+
+
+def prefetch_artists(albums, chunk_size=500):
+    """
+    Loads the artists of the given albums, in chunks, and sets them as the
+    albums' ``artists`` collections so ``ManyToManyField`` doesn't need to
+    load them one album at a time.
+
+    """
+
+    album_artists = dict((album.pk, []) for album in albums)
+    pks = album_artists.keys()
+    for i in xrange(0, len(pks), chunk_size):
+        chunk = pks[i:i + chunk_size]
+        query = g.db.session.query(artists.c.album_pk, Artist).\
+            filter(Artist.pk == artists.c.artist_pk).\
+            filter(artists.c.album_pk.in_(chunk))
+        for album_pk, artist in query:
+            album_artists[album_pk].append(artist)
+
+    for album in albums:
+        set_committed_value(album, 'artists', album_artists[album.pk])
 
 
 class ArtistResource(Resource):
@@ -73,7 +285,7 @@ class ArtistResource(Resource):
 
     def get(self, artist_id=None, artist_slug=None):
         if not artist_id and not artist_slug:
-            return list(self.get_all())
+            return get_listing(self.get_all())
 
         if not artist_id and artist_slug:
             artist = self.get_by_slug(artist_slug)
@@ -86,8 +298,11 @@ class ArtistResource(Resource):
         return marshal(artist, self.get_resource_fields())
 
     def get_all(self):
-        for artist in paginate(Artist.query.order_by(Artist.name)):
-            yield marshal(artist, self.get_resource_fields())
+        resource_fields = self.get_resource_fields()
+        artists = paginate(Artist.query, (Artist.name, Artist.pk))
+        for batch in batches(artists):
+            for artist in batch:
+                yield marshal(artist, resource_fields)
 
     def get_one(self, artist_id):
         artist = Artist.query.get(artist_id)
@@ -107,12 +322,9 @@ class ArtistResource(Resource):
 
     def get_full_tree(self, artist):
         _artist = marshal(artist, self.get_resource_fields())
-        _artist['albums'] = []
 
         albums = AlbumResource()
-
-        for album in artist.albums:
-            _artist['albums'].append(albums.get_full_tree(album))
+        _artist['albums'] = albums.get_full_trees(artist.albums)
 
         return _artist
 
@@ -150,7 +362,7 @@ class AlbumResource(Resource):
 
     def get(self, album_id=None, album_slug=None):
         if not album_id and not album_slug:
-            return list(self.get_many())
+            return get_listing(self.get_many())
 
         if not album_id and album_slug:
             album = self.get_by_slug(album_slug)
@@ -170,9 +382,13 @@ class AlbumResource(Resource):
         else:
             albums = Album.query
 
-        queryset = albums.order_by(Album.year, Album.name, Album.pk)
-        for album in paginate(queryset):
-            yield marshal(album, self.get_resource_fields())
+        albums = paginate(albums, (Album.year, Album.name, Album.pk))
+
+        resource_fields = self.get_resource_fields()
+        for batch in batches(albums):
+            prefetch_artists(batch)
+            for album in batch:
+                yield marshal(album, resource_fields)
 
     def get_one(self, album_id):
         album = Album.query.get(album_id)
@@ -191,15 +407,47 @@ class AlbumResource(Resource):
         return album
 
     def get_full_tree(self, album):
-        _album = marshal(album, self.get_resource_fields())
-        _album['tracks'] = []
+        return self.get_full_trees([album])[0]
+
+    def get_full_trees(self, albums, chunk_size=500):
+        """
+        Retrieves the full trees of the given albums. Their artists, their
+        tracks and the tracks' artists are loaded for all the albums at once,
+        and grouped here, so the number of queries doesn't grow with the
+        number of albums and tracks.
+
+        """
 
+        albums = list(albums)
+        prefetch_artists(albums)
+
+        album_tracks = dict((album.pk, []) for album in albums)
+        pks = album_tracks.keys()
+        for i in xrange(0, len(pks), chunk_size):
+            chunk = pks[i:i + chunk_size]
+            query = Track.query.filter(Track.album_pk.in_(chunk)).\
+                order_by('number', 'title')
+            for track in query:
+                album_tracks[track.album_pk].append(track)
+
+        # The session only holds weak references to the artists, this one
+        # keeps them loaded while the tracks are marshalled.
+        related = prefetch(Artist, [track.artist_pk
+                                    for tracks in album_tracks.itervalues()
+                                    for track in tracks])
+
+        resource_fields = self.get_resource_fields()
         tracks = TrackResource()
+        _albums = []
+        for album in albums:
+            _album = marshal(album, resource_fields)
+            _album['tracks'] = [tracks.get_full_tree(track)
+                                for track in album_tracks[album.pk]]
+            _albums.append(_album)
 
-        for track in album.tracks.order_by('number', 'title'):
-            _album['tracks'].append(tracks.get_full_tree(track))
+        del related
 
-        return _album
+        return _albums
 
     def delete(self, album_id=None):
         if not album_id:
@@ -241,7 +489,7 @@ class TrackResource(Resource):
 
     def get(self, track_id=None, track_slug=None):
         if not track_id and not track_slug:
-            return list(self.get_many())
+            return get_listing(self.get_many())
 
         if not track_id and track_slug:
             track = self.get_by_slug(track_slug)
@@ -253,7 +501,6 @@ class TrackResource(Resource):
 
         return marshal(track, self.get_resource_fields())
 
-    # TODO: Pagination
     def get_many(self):
         album_pk = request.args.get('album')
         artist_pk = request.args.get('artist')
@@ -265,9 +512,18 @@ class TrackResource(Resource):
         else:
             tracks = Track.query
 
-        queryset = tracks.order_by(Track.album_pk, Track.number, Track.pk)
-        for track in paginate(queryset):
-            yield marshal(track, self.get_resource_fields())
+        tracks = paginate(tracks, (Track.album_pk, Track.number, Track.pk))
+
+        resource_fields = self.get_resource_fields()
+        for batch in batches(tracks):
+            # The session only holds weak references to the artists and
+            # albums, this one keeps them loaded while the batch is marshalled.
+            related = (prefetch(Artist, [track.artist_pk for track in batch]),
+                       prefetch(Album, [track.album_pk for track in batch]))
+            for track in batch:
+                yield marshal(track, resource_fields)
+
+            del related
 
     def get_one(self, track_id):
         track = Track.query.get(track_id)
@@ -373,7 +629,7 @@ class LyricsResource(Resource):
         lyric = LyricsCache(track=track, text=text)
 
         g.db.session.add(lyric)
-        g.db.commit()
+        g.db.session.commit()
 
         return JSONResponse(200)
 
@@ -402,7 +658,12 @@ class ConvertResource(Resource):
             log.error(e)
             abort(400)
 
+        converted = converter.converted_file_exists()
         converter.convert()
+        if not converted and converter.converted_file_exists():
+            # The track's files changed, but not the database.
+            bump_library_version(get_library_version_path(app.config))
+
         uri = converter.get_uri()
 
         return JSONResponse(status=301, headers={'Location': uri})
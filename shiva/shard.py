@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Shards are what an indexer writes instead of touching the database: the
+records of the tracks it read, one JSON object per line, between a header and
+a footer. Several indexers, on different machines, can each write a shard for
+a part of the media dirs, to be loaded into the database with ``shiva-indexer
+merge``. Shards whose name ends in ``.gz`` are compressed.
+
+"""
+from datetime import datetime
+import gzip
+import json
+import os
+import socket
+
+from shiva.exceptions import ShardError
+
+VERSION = 1
+
+# Keys of the records written to a shard, see ``read_track``.
+FIELDS = ('path', 'mtime', 'file_size', 'inode', 'device', 'title', 'artist',
+          'album_artist', 'album', 'year', 'number', 'length', 'bitrate',
+          'partial_hash', 'fingerprint')
+
+
+def open_shard(path, mode, compressed=None):
+    if compressed is None:
+        compressed = path.endswith('.gz')
+
+    if compressed:
+        return gzip.open(path, mode)
+
+    return open(path, mode)
+
+
+class ShardWriter(object):
+    """
+    Writes records to a shard. The shard is written to a temporary file,
+    renamed once it's closed, so an indexer that dies half way never leaves
+    an incomplete shard behind.
+
+    """
+
+    def __init__(self, path, part=None, no_metadata=False):
+        self.path = path
+        self.tmp_path = '%s.tmp' % path
+        self.count = 0
+        self.file = open_shard(self.tmp_path, 'wb',
+                               compressed=path.endswith('.gz'))
+        self.write({
+            'shard': VERSION,
+            'host': socket.gethostname(),
+            'created': datetime.utcnow().isoformat(),
+            'part': part,
+            'no_metadata': no_metadata,
+        })
+
+    def write(self, data):
+        self.file.write(json.dumps(data) + '\n')
+
+    def add(self, record, path):
+        """Writes a record, given its path decoded to unicode."""
+
+        data = dict((key, record[key]) for key in FIELDS if key in record)
+        data['path'] = path
+        self.write(data)
+        self.count += 1
+
+    def close(self, **footer):
+        """Writes the footer, with the given values, and closes the shard."""
+
+        footer.update({'end': True, 'count': self.count})
+        self.write(footer)
+        self.file.close()
+        os.rename(self.tmp_path, self.path)
+
+
+class ShardReader(object):
+    """
+    Iterates over the records of a shard, with their paths encoded in UTF-8.
+    The header and the footer are available as ``header`` and ``footer`` once
+    they are read. Raises ``ShardError`` if the file is not a shard, or if
+    it's incomplete.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.footer = None
+
+    def __iter__(self):
+        with open_shard(self.path, 'rb') as shard:
+            for number, line in enumerate(shard, 1):
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    raise ShardError('%s:%d: Invalid JSON' % (self.path,
+                                                              number))
+
+                if self.header is None:
+                    if not isinstance(data, dict) or \
+                            data.get('shard') != VERSION:
+                        raise ShardError('%s is not a shard' % self.path)
+
+                    self.header = data
+
+                    continue
+
+                if self.footer is not None:
+                    raise ShardError('%s:%d: Data after the footer' % (
+                                     self.path, number))
+
+                if data.get('end'):
+                    self.footer = data
+
+                    continue
+
+                data['path'] = data['path'].encode('utf-8')
+
+                yield data
+
+        if self.footer is None:
+            raise ShardError('%s is incomplete' % self.path)
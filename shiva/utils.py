@@ -6,20 +6,42 @@ import datetime
 import logging
 import logging.config
 import os
+import threading
 import traceback
 
 from slugify import slugify as do_slug
 import dateutil.parser
+from mutagen.easyid3 import EasyID3
 import mutagen
 
 import shiva
-from shiva.exceptions import MetadataManagerReadError
+from shiva.exceptions import MetadataManagerReadError, ReadLimitExceeded
 
 
 def get_shiva_path():
     return os.path.dirname(os.path.abspath(shiva.__file__))
 
 
+def get_data_path(filename=None):
+    """
+    Returns the path to the directory where Shiva keeps its data, or to a file
+    in it. Following the `XDG Base Directory Specification
+    <http://standards.freedesktop.org/basedir-spec/basedir-spec-latest.html>`_
+    that is ``$XDG_DATA_HOME/shiva``, which defaults to
+    ``$HOME/.local/share/shiva``. The directory is created if it doesn't
+    exist.
+
+    """
+
+    default_data_home = os.path.join(os.getenv('HOME'), '.local', 'share')
+    data_home = os.getenv('XDG_DATA_HOME') or default_data_home
+    path = os.path.join(data_home, 'shiva')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    return os.path.join(path, filename) if filename else path
+
+
 def get_logger():
     logging_conf = os.path.join(get_shiva_path(), 'logging.conf')
     logging.config.fileConfig(logging_conf)
@@ -43,6 +65,166 @@ def randstr(length=None):
     return digest
 
 
+def get_partial_hash(path, chunk_size=64 * 1024):
+    """
+    Returns a hash of the size and of the first and last ``chunk_size`` bytes
+    of a file. It's fast even for large files, and good enough to recognize a
+    file after it was moved.
+
+    """
+
+    digest = md5()
+    with open(path, 'rb') as _file:
+        _file.seek(0, os.SEEK_END)
+        size = _file.tell()
+        digest.update(str(size))
+
+        _file.seek(0)
+        digest.update(_file.read(chunk_size))
+        if size > chunk_size:
+            _file.seek(max(chunk_size, size - chunk_size))
+            digest.update(_file.read(chunk_size))
+
+    return digest.hexdigest()
+
+
+class Memoized(object):
+    """
+    Function of a single argument with a bounded cache of its results, that
+    discards the least recently used ones first. Keeps count of the calls
+    answered from the cache (hits) and the ones that weren't (misses).
+
+    """
+
+    def __init__(self, function, maxsize=1024):
+        self.function = function
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.cache = {}
+        # Circular doubly linked list of [previous, next, key, value] links,
+        # from the least to the most recently used.
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.lock = threading.Lock()
+
+    def __call__(self, key):
+        root = self.root
+        with self.lock:
+            link = self.cache.get(key)
+            if link is not None:
+                previous, _next, _, value = link
+                previous[1] = _next
+                _next[0] = previous
+                last = root[0]
+                last[1] = root[0] = link
+                link[0] = last
+                link[1] = root
+                self.hits += 1
+
+                return value
+
+            self.misses += 1
+
+        value = self.function(key)
+
+        with self.lock:
+            if key in self.cache:
+                return value
+
+            if len(self.cache) >= self.maxsize:
+                oldest = root[1]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+                del self.cache[oldest[2]]
+
+            last = root[0]
+            link = [last, root, key, value]
+            last[1] = root[0] = self.cache[key] = link
+
+        return value
+
+
+# Every memoized function, by name.
+MEMOIZED = {}
+
+
+def memoize(name, maxsize=1024):
+    """Decorator that memoizes a function of a single argument."""
+
+    def decorator(function):
+        MEMOIZED[name] = Memoized(function, maxsize)
+
+        return MEMOIZED[name]
+
+    return decorator
+
+
+def get_memo_stats():
+    """
+    Returns the hits and misses, so far and in this process, of every
+    memoized function.
+
+    """
+
+    return dict((name, (memoized.hits, memoized.misses))
+                for name, memoized in MEMOIZED.iteritems())
+
+
+def get_memo_deltas(stats):
+    """
+    Returns the hits and misses of the memoized functions that were called
+    since ``stats``, as returned by ``get_memo_stats``, were taken.
+
+    """
+
+    deltas = {}
+    for name, (hits, misses) in get_memo_stats().iteritems():
+        _hits, _misses = stats[name]
+        if hits != _hits or misses != _misses:
+            deltas[name] = (hits - _hits, misses - _misses)
+
+    return deltas
+
+
+@memoize('year', maxsize=1024)
+def parse_year(date):
+    """
+    Returns the year of a date, in any format dateutil understands, or None.
+
+    """
+
+    default_date = datetime.datetime(datetime.MINYEAR, 1, 1)
+    try:
+        parsed_date = dateutil.parser.parse(date, default=default_date)
+    except ValueError:
+        return None
+
+    parsed_date = parsed_date.replace(tzinfo=None)
+    if parsed_date != default_date:
+        return parsed_date.year
+
+    return None
+
+
+@memoize('track_number', maxsize=256)
+def parse_track_number(number):
+    """
+    Returns the track number of a tag like ``3``, or ``3/12`` (track 3 out of
+    12), or None.
+
+    """
+
+    try:
+        return int(number.partition('/')[0])
+    except (AttributeError, ValueError):
+        return None
+
+
+# Names and titles repeat a lot across a collection.
+make_slug = memoize('slug', maxsize=8192)(do_slug)
+
+
 def slugify(text):
     """
     Generates an alphanumeric slug. If the resulting slug is numeric-only a
@@ -53,7 +235,7 @@ def slugify(text):
     if not text:
         return ''
 
-    slug = do_slug(text)
+    slug = make_slug(text)
     if not slug:
         slug = randstr(length=6)
 
@@ -68,6 +250,22 @@ def slugify(text):
     return slug
 
 
+def normalize_name(name):
+    """
+    Normalizes an artist or album name for comparison: lowercases it and
+    collapses the whitespace.
+
+    """
+
+    if not name:
+        return u''
+
+    if isinstance(name, str):
+        name = name.decode('utf-8', 'replace')
+
+    return u' '.join(name.lower().split())
+
+
 def _import(class_path):
     """ Imports a module or class from a string in dot notation. """
 
@@ -105,7 +303,12 @@ class MetadataManager(object):
     def __init__(self, filepath):
         self._original_path = filepath
         try:
-            self.reader = mutagen.File(filepath, easy=True)
+            try:
+                self.reader = mutagen.File(filepath, easy=True)
+            except ReadLimitExceeded, e:
+                # Only in header-only mode, see ``shiva.reader``.
+                with e.reader.unbounded():
+                    self.reader = mutagen.File(filepath, easy=True)
         except Exception, e:
             raise MetadataManagerReadError(e.message)
 
@@ -132,22 +335,23 @@ class MetadataManager(object):
         self.reader['album'] = value
 
     @property
-    def release_year(self):
-        """The album release year."""
-        default_date = datetime.datetime(datetime.MINYEAR, 1, 1)
-        default_date = default_date.replace(tzinfo=None)
-        date = self._getter('date', '')
-        try:
-            parsed_date = dateutil.parser.parse(date, default=default_date)
-        except ValueError:
-            return None
+    def album_artist(self):
+        """The album artist name, if the file has one."""
+        for attr in ('albumartist', 'album artist'):
+            if attr in self.reader:
+                return self.reader[attr][0]
 
-        parsed_date = parsed_date.replace(tzinfo=None)
-        if parsed_date != default_date:
-            return parsed_date.year
+        # EasyID3 calls TPE2, the de facto album artist frame, 'performer'.
+        if isinstance(self.reader.tags, EasyID3):
+            return self._getter('performer')
 
         return None
 
+    @property
+    def release_year(self):
+        """The album release year."""
+        return parse_year(self._getter('date', ''))
+
     @release_year.setter
     def release_year(self, value):
         self.reader['year'] = value
@@ -155,13 +359,7 @@ class MetadataManager(object):
     @property
     def track_number(self):
         """The track number."""
-
-        try:
-            _number = int(self._getter('tracknumber'))
-        except (TypeError, ValueError):
-            _number = None
-
-        return _number
+        return parse_track_number(self._getter('tracknumber'))
 
     @track_number.setter
     def track_number(self, value):
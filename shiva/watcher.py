@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Keeps the database in sync with the media dirs, by listening to the
+filesystem events that Linux's inotify reports for them.
+
+"""
+from collections import OrderedDict
+from time import time
+import os
+
+from sqlalchemy import bindparam
+
+from shiva import models as m
+from shiva.utils import get_logger
+
+log = get_logger()
+
+# Actions that can be pending for a path.
+INDEX = 'index'
+INDEX_DIR = 'index-dir'
+DELETE = 'delete'
+DELETE_DIR = 'delete-dir'
+MOVE = 'move'
+MOVE_DIR = 'move-dir'
+
+
+class Watcher(object):
+    """
+    Watches the valid dirs of every MediaDir (skipping the excluded ones) and
+    applies the changes to the database through the given ``Indexer``.
+
+    Events are not applied as they arrive. They are coalesced by path and
+    applied all at once after ``debounce`` seconds without new events, or
+    after ``max_delay`` seconds if they never stop coming. That way copying a
+    whole album in only triggers one round of indexing, and a file that is
+    created and then renamed is only read once.
+
+    """
+
+    def __init__(self, indexer, debounce=2, max_delay=30):
+        try:
+            import pyinotify
+        except ImportError:
+            raise RuntimeError('Watching the media dirs requires pyinotify. '
+                               'Install it with: pip install pyinotify')
+        # The indexer imports this module.
+        from shiva.indexer import PathIndex
+
+        self.pyinotify = pyinotify
+        self.indexer = indexer
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+        # Changes can't be known in advance, so every track may already be in
+        # the DB, and must be read and written one by one.
+        self.indexer.jobs = 1
+        self.indexer.bulk = None
+        # The path index is a snapshot of the DB when the indexer started, it
+        # would take a file that was deleted and then restored as unchanged.
+        # With an empty one every record is a new track, and moves are
+        # already reported by inotify.
+        self.indexer.path_index = PathIndex()
+
+        self.changes = OrderedDict()
+        self.first_event = None
+        self.last_event = None
+
+        self.excluded = []
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self.process_event)
+
+        mask = (pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE |
+                pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+                pyinotify.IN_MOVED_TO | pyinotify.IN_MOVE_SELF)
+        for mobject in indexer.media_dirs:
+            self.excluded.extend(os.path.normpath(path)
+                                 for path in mobject.get_excluded_dirs())
+            for mdir in mobject.get_valid_dirs():
+                log.info('Watching %s' % mdir)
+                self.manager.add_watch(mdir, mask, rec=True, auto_add=True,
+                                       exclude_filter=self.is_excluded)
+
+    def is_excluded(self, path):
+        path = os.path.normpath(path)
+        for excluded in self.excluded:
+            if path == excluded or path.startswith(excluded + os.sep):
+                return True
+
+        return False
+
+    def process_event(self, event):
+        """Records the action that the event requires for its path."""
+
+        path = event.pathname
+        if self.is_excluded(path):
+            return None
+
+        mask = event.mask
+        is_dir = event.dir
+        src = getattr(event, 'src_pathname', None)
+
+        if mask & (self.pyinotify.IN_CREATE | self.pyinotify.IN_CLOSE_WRITE):
+            self.add_change(path, INDEX_DIR if is_dir else INDEX)
+        elif mask & self.pyinotify.IN_DELETE:
+            self.add_change(path, DELETE_DIR if is_dir else DELETE)
+        elif mask & self.pyinotify.IN_MOVED_FROM:
+            # Becomes a move if the matching IN_MOVED_TO arrives.
+            self.add_change(path, DELETE_DIR if is_dir else DELETE)
+        elif mask & self.pyinotify.IN_MOVED_TO:
+            if src is None or self.is_excluded(src):
+                self.add_change(path, INDEX_DIR if is_dir else INDEX)
+            else:
+                pending = self.changes.pop(src, None)
+                if pending in (INDEX, INDEX_DIR):
+                    # Not even in the DB yet.
+                    self.add_change(path, pending)
+                else:
+                    self.add_change(path, (MOVE_DIR if is_dir else MOVE, src))
+
+    def add_change(self, path, action):
+        now = time()
+        if not self.changes:
+            self.first_event = now
+        self.last_event = now
+
+        # Keep the changes in the order they happened.
+        self.changes.pop(path, None)
+        self.changes[path] = action
+
+    def is_settled(self):
+        """Whether the pending changes should be applied now."""
+
+        if not self.changes:
+            return False
+
+        now = time()
+        if now - self.last_event >= self.debounce:
+            return True
+
+        return now - self.first_event >= self.max_delay
+
+    def apply_changes(self):
+        changes, self.changes = self.changes, OrderedDict()
+
+        to_index = []
+        for path, action in changes.iteritems():
+            if action == INDEX:
+                to_index.append(path)
+            elif action == INDEX_DIR:
+                to_index.extend(self.walk(path))
+            elif action == DELETE:
+                self.delete(path)
+            elif action == DELETE_DIR:
+                self.delete(path, is_dir=True)
+            else:
+                action, src = action
+                self.move(src, path, is_dir=(action == MOVE_DIR))
+
+        self.index(to_index)
+
+        self.indexer.commit()
+        self.indexer.make_slugs_unique()
+        self.indexer.enrich()
+
+    def index(self, paths):
+        # A new directory and the files in it are reported separately.
+        paths = [path for path in OrderedDict.fromkeys(paths)
+                 if self.indexer.is_track(path)]
+        if not paths:
+            return None
+
+        tracks = ((path, None) for path in paths)
+        records = list(self.indexer.stat_tracks(tracks))
+        for record in records:
+            # The DB may have changed since the indexer started, look up every
+            # track by its path.
+            record['modified'] = True
+
+        for record in self.indexer.read_tracks(records):
+            self.indexer.save_track(record)
+
+    def walk(self, path):
+        """Returns the paths of the tracks under the given directory."""
+
+        return [_path for _path, stat in
+                self.indexer.walk(path, exclude=self.excluded)]
+
+    def get_tracks(self, path, is_dir=False):
+        """Returns a query for the track at path, or under it."""
+
+        _path = path.decode('utf-8')
+        if not is_dir:
+            return m.Track.query.filter_by(path=_path)
+
+        prefix = _path.rstrip(u'/') + u'/'
+        escaped = prefix.replace(u'\\', u'\\\\').replace(u'%', u'\\%').\
+            replace(u'_', u'\\_')
+
+        return m.Track.query.filter(m.Track.path.like(escaped + u'%',
+                                                      escape=u'\\'))
+
+    def delete(self, path, is_dir=False):
+        if is_dir:
+            # If the directory was moved out of the media dirs it's still
+            # being watched, in its new location.
+            wd = self.manager.get_wd(path)
+            if wd is not None:
+                self.manager.rm_watch(wd, rec=True, quiet=True)
+
+        pks = [pk for pk, in self.get_tracks(path, is_dir).values(m.Track.pk)]
+        if pks:
+            log.info('[ DELETED ] %s (%d tracks)' % (path, len(pks)))
+            self.indexer.delete_tracks(pks)
+
+    def move(self, src, dest, is_dir=False):
+        _src = src.decode('utf-8')
+        _dest = dest.decode('utf-8')
+        tracks = self.get_tracks(src, is_dir).values(m.Track.pk, m.Track.path)
+        moved = [{'_pk': pk, 'path': _dest + path[len(_src):]}
+                 for pk, path in tracks]
+        if not moved:
+            # Never indexed, maybe it wasn't a track. Try again.
+            if is_dir:
+                self.index(self.walk(dest))
+            else:
+                self.index([dest])
+
+            return None
+
+        log.info('[ MOVED ] %s -> %s (%d tracks)' % (src, dest, len(moved)))
+        table = m.Track.__table__
+        query = table.update().where(table.c.pk == bindparam('_pk')).\
+            values(path=bindparam('path'))
+        self.indexer.session.execute(query, moved)
+
+    def run(self):
+        """Blocks forever, applying the changes as they come."""
+
+        log.info('Waiting for changes...')
+        while True:
+            if self.notifier.check_events(timeout=500):
+                self.notifier.read_events()
+                self.notifier.process_events()
+
+            if self.is_settled():
+                self.apply_changes()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import atexit
+import os
+import shutil
+import tempfile
+import unittest
+
+CONFIG = """
+from shiva.media import MediaDir
+SQLALCHEMY_DATABASE_URI = %(uri)r
+LIBRARY_VERSION_FILE = %(version_file)r
+MEDIA_DIRS = (MediaDir(%(tmp_dir)r),)
+"""
+
+# The database of the app, once configured by ``get_app``.
+uri = None
+
+
+def get_app():
+    """
+    Returns the app, with its tables created in a temporary database. The app
+    reads its config when imported, so the first call points it there. Raises
+    SkipTest if a config file takes precedence, like ``shiva/config/local.py``,
+    rather than writing to another database.
+
+    """
+
+    global uri
+
+    if uri is None:
+        tmp_dir = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, tmp_dir)
+        uri = 'sqlite:///%s' % os.path.join(tmp_dir, 'shiva.db')
+        config_path = os.path.join(tmp_dir, 'config.py')
+        with open(config_path, 'w') as config_file:
+            config_file.write(CONFIG % {
+                'uri': uri,
+                'version_file': os.path.join(tmp_dir, 'library.version'),
+                'tmp_dir': tmp_dir,
+            })
+        os.environ['SHIVA_CONFIG'] = config_path
+
+    from shiva.app import app, db
+
+    if app.config['SQLALCHEMY_DATABASE_URI'] != uri:
+        raise unittest.SkipTest('The app is configured to use %s, refusing '
+                                'to write to it.' %
+                                app.config['SQLALCHEMY_DATABASE_URI'])
+
+    db.create_all()
+
+    return app
+
+
+def clear_database():
+    """Deletes the rows of every table."""
+
+    from shiva.models import db
+
+    db.session.remove()
+    for table in reversed(db.metadata.sorted_tables):
+        db.session.execute(table.delete())
+    db.session.commit()
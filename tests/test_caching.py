@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the version of the library that tags the API's responses.
+
+"""
+from datetime import date
+import unittest
+
+from tests import clear_database, get_app
+
+app = db = models = None
+
+
+def setUpModule():
+    global app, db, models
+
+    app = get_app()
+    from shiva import models
+    from shiva.models import db
+
+
+class CachingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        db.session.execute(models.Track.__table__.insert(), {
+            'pk': 1, 'path': u'/music/track.mp3', 'title': 'Track',
+            'slug': 'track', 'date_added': date.today()})
+        db.session.commit()
+
+    def tearDown(self):
+        clear_database()
+
+    def get_etag(self):
+        response = self.client.get('/tracks')
+        self.assertEqual(response.status_code, 200)
+
+        return response.headers['ETag']
+
+    def cache_lyrics(self, method):
+        with app.test_request_context('/track/1/lyrics', method=method):
+            db.session.add(models.LyricsCache(track_pk=1, text=u'Lyrics'))
+            db.session.commit()
+            db.session.remove()
+
+    def test_not_modified_since(self):
+        response = self.client.get('/tracks')
+        last_modified = response.headers['Last-Modified']
+        response = self.client.get('/tracks', headers={
+            'If-Modified-Since': last_modified})
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_not_modified_with_cors(self):
+        etag = self.get_etag()
+        app.config['CORS_ENABLED'] = True
+        try:
+            response = self.client.get('/tracks', headers={
+                'If-None-Match': etag, 'Origin': 'http://example.com'})
+        finally:
+            app.config['CORS_ENABLED'] = False
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['Access-Control-Allow-Origin'],
+                         '*')
+        self.assertEqual(response.headers['Access-Control-Expose-Headers'],
+                         'ETag, Last-Modified, Link')
+
+    def test_scraped_lyrics_dont_change_the_version(self):
+        etag = self.get_etag()
+        self.cache_lyrics('GET')
+
+        self.assertEqual(self.get_etag(), etag)
+        response = self.client.get('/tracks', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_posted_lyrics_change_the_version(self):
+        etag = self.get_etag()
+        self.cache_lyrics('POST')
+
+        self.assertNotEqual(self.get_etag(), etag)
+
+
+if __name__ == '__main__':
+    unittest.main()
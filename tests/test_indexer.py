@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the tracks that the indexer prunes from the database.
+
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from tests import clear_database, get_app
+
+app = db = models = None
+Indexer = MediaDir = None
+
+
+def setUpModule():
+    global app, db, models, Indexer, MediaDir
+
+    app = get_app()
+    from shiva import models
+    from shiva.indexer import Indexer
+    from shiva.media import MediaDir
+    from shiva.models import db
+
+
+class PruneTestCase(unittest.TestCase):
+    def setUp(self):
+        self.media_dir = tempfile.mkdtemp()
+        self.paths = []
+        for name in ('a.mp3', 'b.mp3'):
+            path = os.path.join(self.media_dir, name)
+            with open(path, 'wb') as track_file:
+                track_file.write('\0' * 1024)
+            self.paths.append(path)
+
+        self.index()
+
+    def tearDown(self):
+        db.session.remove()
+        clear_database()
+        shutil.rmtree(self.media_dir)
+
+    def index(self, prune=False):
+        config = dict(app.config, MEDIA_DIRS=(MediaDir(self.media_dir),))
+        indexer = Indexer(config, no_metadata=True)
+        indexer.run()
+        indexer.commit()
+        if prune:
+            indexer.prune()
+            indexer.commit()
+
+    def get_paths(self):
+        return sorted(path.encode('utf-8') for path, in
+                      db.session.query(models.Track.path))
+
+    def test_deleted_track_is_pruned(self):
+        os.remove(self.paths[0])
+        self.index(prune=True)
+
+        self.assertEqual(self.get_paths(), self.paths[1:])
+
+    def test_empty_mount_point_is_not_pruned(self):
+        # What's left of a disk that is not mounted.
+        for path in self.paths:
+            os.remove(path)
+        self.index(prune=True)
+
+        self.assertEqual(self.get_paths(), self.paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
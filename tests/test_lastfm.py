@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the Last.FM stage of the indexer, against a stub of the web service
+running on localhost.
+
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from time import time
+from urlparse import parse_qs
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from shiva.exceptions import LastFMError
+from shiva.lastfm import Enricher, LastFMCache, LastFMClient, RateLimiter
+
+SIZES = ('small', 'medium', 'large', 'extralarge', 'mega')
+
+
+def images(prefix, sizes=SIZES):
+    return ''.join('<image size="%s">http://img/%s-%s.png</image>' % (
+                   size, prefix, size) for size in sizes)
+
+
+def artist(name, sizes=SIZES):
+    return (200, '<lfm status="ok"><artist><name>%s</name>%s</artist></lfm>' %
+            (name, images(name, sizes)))
+
+
+def album(name, release_date):
+    return (200, '<lfm status="ok"><album><name>%s</name><releasedate>%s'
+                 '</releasedate>%s</album></lfm>' % (name, release_date,
+                                                     images(name)))
+
+
+def error(code, message='Error'):
+    return (200, '<lfm status="failed"><error code="%d">%s</error></lfm>' %
+            (code, message))
+
+
+SERVER_ERROR = (500, '<html><body>Internal Server Error</body></html>')
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        params = dict((key, values[0])
+                      for key, values in parse_qs(body).iteritems())
+        status, content = self.server.stub.answer(params)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class LastFMStub(object):
+    """
+    Answers requests with the responses given for their method and artist
+    (and album). Several responses for the same lookup are used in turn, the
+    last one repeated.
+
+    """
+
+    def __init__(self):
+        self.responses = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+        self.server = StubServer(('127.0.0.1', 0), StubHandler)
+        self.server.stub = self
+        self.url = 'http://127.0.0.1:%d/2.0/' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_key(self, params):
+        return (params['method'].lower(), params.get('artist'),
+                params.get('album'))
+
+    def add(self, method, artist, album=None, *responses):
+        self.responses[(method, artist, album)] = list(responses)
+
+    def answer(self, params):
+        key = self.get_key(params)
+        with self.lock:
+            self.requests.append((time(), key))
+            responses = self.responses.get(key) or [error(6, 'Not found')]
+            if len(responses) > 1:
+                return responses.pop(0)
+
+            return responses[0]
+
+    def count(self, method, artist, album=None):
+        return len([key for _time, key in self.requests
+                    if key == (method, artist, album)])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class LastFMTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stub = LastFMStub()
+        self.client = self.get_client()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def get_client(self, url=None, **kwargs):
+        kwargs.setdefault('retries', 2)
+        kwargs.setdefault('backoff', 0)
+        kwargs.setdefault('timeout', 5)
+
+        return LastFMClient('key', api_url=url or self.stub.url, **kwargs)
+
+
+class LastFMClientTestCase(LastFMTestCase):
+    def test_artist_image(self):
+        self.stub.add('artist.getinfo', 'Cher', None, artist('cher'))
+
+        self.assertEqual(self.client.get_artist('Cher'),
+                         {'image': 'http://img/cher-mega.png'})
+        self.assertEqual(self.stub.count('artist.getinfo', 'Cher'), 1)
+
+    def test_smaller_image_if_size_missing(self):
+        self.stub.add('artist.getinfo', 'Cher', None,
+                      artist('cher', sizes=('small', 'medium')))
+
+        self.assertEqual(self.client.get_artist('Cher'),
+                         {'image': 'http://img/cher-medium.png'})
+
+    def test_album_cover_and_year_from_one_request(self):
+        self.stub.add('album.getinfo', 'Cher', 'Believe',
+                      album('believe', '    22 Oct 1998, 00:00'))
+
+        self.assertEqual(self.client.get_album('Cher', 'Believe'), {
+            'cover': 'http://img/believe-extralarge.png',
+            'year': 1998,
+        })
+        self.assertEqual(self.stub.count('album.getinfo', 'Cher', 'Believe'),
+                         1)
+
+    def test_album_without_release_date(self):
+        self.stub.add('album.getinfo', 'Cher', 'Believe',
+                      album('believe', ''))
+
+        self.assertEqual(self.client.get_album('Cher', 'Believe')['year'],
+                         None)
+
+    def test_not_found(self):
+        self.assertEqual(self.client.get_artist('Nobody'), None)
+        self.assertEqual(self.client.get_album('Nobody', 'Nothing'), None)
+        # Permanent errors are not retried.
+        self.assertEqual(self.stub.count('artist.getinfo', 'Nobody'), 1)
+
+    def test_temporary_error_is_retried(self):
+        self.stub.add('artist.getinfo', 'Cher', None, error(11, 'Offline'),
+                      error(29, 'Rate limit exceeded'), artist('cher'))
+
+        self.assertEqual(self.client.get_artist('Cher'),
+                         {'image': 'http://img/cher-mega.png'})
+        self.assertEqual(self.stub.count('artist.getinfo', 'Cher'), 3)
+
+    def test_server_error_gives_up(self):
+        self.stub.add('artist.getinfo', 'Cher', None, SERVER_ERROR)
+
+        self.assertRaises(LastFMError, self.client.get_artist, 'Cher')
+        # The first attempt and two retries.
+        self.assertEqual(self.stub.count('artist.getinfo', 'Cher'), 3)
+
+    def test_network_error_gives_up(self):
+        # A port nobody listens on.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%d/2.0/' % sock.getsockname()[1]
+        sock.close()
+
+        client = self.get_client(url=url)
+        self.assertRaises(LastFMError, client.get_artist, 'Cher')
+
+    def test_timeout(self):
+        # Accepts connections, but never answers.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        url = 'http://127.0.0.1:%d/2.0/' % sock.getsockname()[1]
+
+        client = self.get_client(url=url, retries=0, timeout=0.2)
+        try:
+            started = time()
+            self.assertRaises(LastFMError, client.get_artist, 'Cher')
+            self.assertTrue(time() - started < 2)
+        finally:
+            sock.close()
+
+        # Only pylast's connections are affected.
+        self.assertEqual(socket.getdefaulttimeout(), None)
+
+    def test_rate_limiter(self):
+        rate = 20
+        names = ['Artist %d' % n for n in xrange(6)]
+        for name in names:
+            self.stub.add('artist.getinfo', name, None, artist(name))
+
+        client = self.get_client(rate_limiter=RateLimiter(rate))
+        enricher = Enricher(client, workers=3)
+        jobs = [(name, 'get_artist', (name,)) for name in names]
+        results = dict(enricher.fetch(jobs))
+
+        self.assertEqual(sorted(results), names)
+        times = sorted(_time for _time, key in self.stub.requests)
+        self.assertEqual(len(times), len(names))
+        # Some slack for the time it takes to send a request.
+        self.assertTrue(times[-1] - times[0] >= (len(names) - 1.5) / rate)
+
+
+class EnricherTestCase(LastFMTestCase):
+    def setUp(self):
+        super(EnricherTestCase, self).setUp()
+        self.stub.add('artist.getinfo', 'Cher', None, artist('cher'))
+        self.stub.add('artist.getinfo', 'Broken', None, SERVER_ERROR)
+        self.jobs = [
+            (1, 'get_artist', ('Cher',)),
+            (2, 'get_artist', ('Nobody',)),
+        ]
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmp_dir, 'lastfm.db')
+
+    def tearDown(self):
+        super(EnricherTestCase, self).tearDown()
+        shutil.rmtree(self.tmp_dir)
+
+    def fetch(self, jobs=None, **kwargs):
+        cache = LastFMCache(self.cache_path, **kwargs)
+        enricher = Enricher(self.client, workers=2, cache=cache)
+
+        return dict(enricher.fetch(jobs or self.jobs)), cache
+
+    def test_failed_lookups_are_left_out(self):
+        jobs = self.jobs + [(3, 'get_artist', ('Broken',))]
+        results, cache = self.fetch(jobs)
+
+        self.assertEqual(results, {
+            1: {'image': 'http://img/cher-mega.png'},
+            2: None,
+        })
+
+        # Failures are not cached, the lookup is tried again.
+        self.fetch(jobs)
+        self.assertEqual(self.stub.count('artist.getinfo', 'Broken'), 6)
+
+    def test_cache(self):
+        first, cache = self.fetch()
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+        second, cache = self.fetch()
+        self.assertEqual(second, first)
+        self.assertEqual((cache.hits, cache.misses), (2, 0))
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_cache_names_are_normalized(self):
+        self.fetch()
+        results, cache = self.fetch([(1, 'get_artist', (u'  CHER ',))])
+
+        self.assertEqual(results, {1: {'image': 'http://img/cher-mega.png'}})
+        self.assertEqual(cache.hits, 1)
+
+    def test_cache_ttl(self):
+        self.fetch(ttl=0)
+        results, cache = self.fetch(ttl=0)
+
+        # Only the lookup that found something expired.
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(self.stub.count('artist.getinfo', 'Cher'), 2)
+        self.assertEqual(self.stub.count('artist.getinfo', 'Nobody'), 1)
+        self.assertEqual(results[1], {'image': 'http://img/cher-mega.png'})
+
+    def test_cache_negative_ttl(self):
+        self.fetch(negative_ttl=0)
+        results, cache = self.fetch(negative_ttl=0)
+
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(self.stub.count('artist.getinfo', 'Cher'), 1)
+        self.assertEqual(self.stub.count('artist.getinfo', 'Nobody'), 2)
+        self.assertEqual(results[2], None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the conditions that pick the rows after a pagination cursor.
+
+"""
+from itertools import product
+import sqlite3
+import unittest
+
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, select
+
+from shiva.resources import after
+
+
+class AfterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        metadata = MetaData()
+        self.table = Table('rows', metadata,
+                           Column('pk', Integer, primary_key=True),
+                           Column('a', Integer),
+                           Column('b', Integer))
+        metadata.create_all(self.engine)
+
+        # Every combination of NULLs and values, twice.
+        values = list(product((None, 1, 2), (None, 1, 2))) * 2
+        self.engine.execute(self.table.insert(), [{'a': a, 'b': b}
+                                                  for a, b in values])
+        columns = self.table.c
+        self.keys = (columns.a, columns.b, columns.pk)
+
+    def get_rows(self, nulls_first, condition=None):
+        order = [key.nullsfirst() if nulls_first else key.nullslast()
+                 for key in self.keys]
+        query = select(self.keys).order_by(*order)
+        if condition is not None:
+            query = query.where(condition)
+
+        return [tuple(row) for row in self.engine.execute(query)]
+
+    def check_every_cursor(self, nulls_first):
+        rows = self.get_rows(nulls_first)
+        for position, row in enumerate(rows):
+            condition = after(self.keys, row, nulls_first=nulls_first)
+            self.assertEqual(self.get_rows(nulls_first, condition),
+                             rows[position + 1:])
+
+    def test_nulls_first(self):
+        self.check_every_cursor(nulls_first=True)
+
+    @unittest.skipIf(sqlite3.sqlite_version_info < (3, 30),
+                     'SQLite supports NULLS LAST since 3.30')
+    def test_nulls_last(self):
+        self.check_every_cursor(nulls_first=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Tests that the listings and full trees are served with a fixed number of
+queries, no matter how many rows they include.
+
+"""
+from datetime import date
+import json
+import unittest
+
+from sqlalchemy import event
+
+from tests import clear_database, get_app
+
+app = db = models = None
+# Statements executed, see ``count_query``.
+queries = [0]
+
+URLS = (
+    '/artists',
+    '/albums',
+    '/tracks',
+    '/artist/1?fulltree=1',
+    '/album/1?fulltree=1',
+)
+
+
+def setUpModule():
+    global app, db, models
+
+    app = get_app()
+    from shiva import models
+    from shiva.models import db
+
+    event.listen(db.engine, 'after_cursor_execute', count_query)
+
+
+def count_query(*args):
+    queries[0] += 1
+
+
+def add_rows(start, count):
+    """
+    Adds ``count`` artists and albums, starting at the ``start`` primary key,
+    each album by its own artist and by artist 1. Every album gets a track by
+    its artist, and album 1 another one.
+
+    """
+
+    pks = range(start, start + count)
+    today = date.today()
+    session = db.session
+    session.execute(models.Artist.__table__.insert(), [
+        {'pk': pk, 'name': 'Artist %d' % pk, 'slug': 'artist-%d' % pk,
+         'date_added': today}
+        for pk in pks])
+    session.execute(models.Album.__table__.insert(), [
+        {'pk': pk, 'name': 'Album %d' % pk, 'slug': 'album-%d' % pk,
+         'year': 1950 + pk % 60, 'date_added': today}
+        for pk in pks])
+    session.execute(models.artists.insert(), [
+        {'album_pk': pk, 'artist_pk': artist_pk}
+        for pk in pks for artist_pk in set((pk, 1))])
+    session.execute(models.Track.__table__.insert(), [
+        {'path': u'/music/%d/%d.mp3' % (album_pk, pk),
+         'title': 'Track %d' % pk, 'slug': 'track-%d-%d' % (album_pk, pk),
+         'number': number,
+         'date_added': today, 'album_pk': album_pk, 'artist_pk': pk}
+        for pk in pks for number, album_pk in enumerate(set((pk, 1)))])
+    session.commit()
+
+
+class QueryCountTestCase(unittest.TestCase):
+    rows = 100
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def tearDown(self):
+        clear_database()
+
+    def get(self, url):
+        """Returns the response's decoded content and the queries it took."""
+
+        queries[0] = 0
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        # Streamed responses are only read, and queried, here.
+        data = json.loads(response.data)
+        # The session lasts as long as the request.
+        db.session.remove()
+
+        return data, queries[0]
+
+    def get_all(self):
+        return dict((url, self.get(url)) for url in URLS)
+
+    def test_queries_dont_grow_with_rows(self):
+        add_rows(1, self.rows)
+        before = self.get_all()
+        add_rows(self.rows + 1, self.rows)
+        after = self.get_all()
+
+        for url in URLS:
+            self.assertEqual(after[url][1], before[url][1],
+                             '%s: %d queries for %d rows, %d for %d' % (
+                                 url, before[url][1], self.rows,
+                                 after[url][1], self.rows * 2))
+
+        # Twice the rows were actually served.
+        self.assertEqual(len(after['/artists'][0]), self.rows * 2)
+        self.assertEqual(len(after['/albums'][0]), self.rows * 2)
+        self.assertEqual(len(after['/tracks'][0]), self.rows * 4 - 1)
+        self.assertEqual(len(after['/artist/1?fulltree=1'][0]['albums']),
+                         self.rows * 2)
+        self.assertEqual(len(after['/album/1?fulltree=1'][0]['tracks']),
+                         self.rows * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the changes that the watcher applies to the database.
+
+"""
+from datetime import date
+import os
+import shutil
+import tempfile
+import unittest
+
+from tests import clear_database, get_app
+
+app = db = models = None
+Indexer = Watcher = None
+DELETE = INDEX = None
+
+
+def setUpModule():
+    global app, db, models, Indexer, Watcher, DELETE, INDEX
+
+    try:
+        import pyinotify
+    except ImportError:
+        raise unittest.SkipTest('The watcher requires pyinotify')
+
+    app = get_app()
+    from shiva import models
+    from shiva.indexer import Indexer
+    from shiva.models import db
+    from shiva.watcher import DELETE, INDEX, Watcher
+
+
+class WatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'track.mp3')
+        with open(self.path, 'wb') as track_file:
+            track_file.write('\0' * 1024)
+
+        # Indexed before the watcher started, with the file's current stats.
+        stat = os.stat(self.path)
+        db.session.execute(models.Track.__table__.insert(), {
+            'pk': 1, 'path': self.path.decode('utf-8'), 'title': 'Track',
+            'slug': 'track', 'date_added': date.today(),
+            'mtime': int(stat.st_mtime), 'file_size': stat.st_size,
+            'inode': stat.st_ino, 'device': stat.st_dev})
+        db.session.commit()
+
+        self.watcher = Watcher(Indexer(app.config, no_metadata=True))
+
+    def tearDown(self):
+        db.session.remove()
+        clear_database()
+        shutil.rmtree(self.tmp_dir)
+
+    def apply(self, action):
+        self.watcher.add_change(self.path, action)
+        self.watcher.apply_changes()
+
+    def get_paths(self):
+        return [path for path, in db.session.query(models.Track.path)]
+
+    def test_deleted_and_restored(self):
+        self.apply(DELETE)
+        self.assertEqual(self.get_paths(), [])
+
+        # Same file, same stats.
+        self.apply(INDEX)
+        self.assertEqual(self.get_paths(), [self.path.decode('utf-8')])
+
+    def test_unchanged_track_is_not_duplicated(self):
+        self.apply(INDEX)
+        self.assertEqual(self.get_paths(), [self.path.decode('utf-8')])
+
+
+if __name__ == '__main__':
+    unittest.main()